@@ -21,6 +21,21 @@ __version__ = "1.4.2"
 # 07-jan-2015 add countinvis keyword
 # 25-nov-2015 add significance keywords
 # 21-aug-2023 add heatmap option
+# 19-oct-2026 add TOPN, BOTTOMN, and TOPNGROUP keywords
+# 19-oct-2026 add HMSHARED keyword
+# 19-oct-2026 add rank and quantile heatmap scales, HMCLIP and HMBINS keywords
+# 19-oct-2026 add HMGROUP keyword
+# 19-oct-2026 add KEEPSESSION keyword
+# 19-oct-2026 add MAXTIME, MAXTABLES, and RESUME keywords
+# 19-oct-2026 add PROCESS=LAST, LASTPROCS, and FIRSTMATCH
+# 19-oct-2026 add LABELSFILE keyword
+# 19-oct-2026 add ROWSELECT and COLSELECT keywords
+# 19-oct-2026 add WIDTHS=AUTO
+# 19-oct-2026 add IGNORECASE keyword
+# 19-oct-2026 add JOURNAL and REVERT keywords
+# 19-oct-2026 add DIFF keyword
+# 19-oct-2026 add CHUNKSIZE keyword
+# 19-oct-2026 build the syntax templates once at module load
 
 
 from extension import Template, Syntax, processcmd
@@ -38,20 +53,28 @@ import modifytables
     #pass
 
 helptext="""SPSS MODIFY TABLES SUBTYPE=subtypes SELECT=list of columns or rows to operate on
-    [PROCESS={PRECEDING* | ALL}
+    [ROWSELECT=list of rows] [COLSELECT=list of columns]
+    [PROCESS={PRECEDING* | LAST | ALL} [LASTPROCS=number] [FIRSTMATCH={YES|NO*}]
     [DIMENSION={COLUMNS* | ROWS}] 
     [LEVEL=number]
     [HIDE={TRUE|FALSE}
-    [REGEXP={NO*|YES}]
-    [PRINTLABELS={YES|NO*}]
-[/WIDTHS [WIDTHS=list-of-widths] [ROWLABELS=list of row label numbers] 
+    [REGEXP={NO*|YES}] [IGNORECASE={NO*|YES}]
+    [PRINTLABELS={YES|NO*}] [LABELSFILE="filespec"]
+    [KEEPSESSION={YES|NO*}]
+    [MAXTIME=seconds] [MAXTABLES=number] [RESUME={YES|NO*}]
+    [JOURNAL={YES|NO*}] [REVERT={YES|NO*}] [DIFF={YES|NO*}] [CHUNKSIZE=rows]
+[/WIDTHS [WIDTHS=list-of-widths or AUTO] [ROWLABELS=list of row label numbers] 
     [ROWLABELVALUES=list of widths]]
 [/STYLES [TEXTSTYLE={REGULAR|BOLD|ITALIC|BOLDITALIC}]
     [TEXTCOLOR=RGB values]
     [BACKGROUNDCOLOR=RGB values]
     [CUSTOMFUNCTION="module.function" ...]
     [TLOOK="filespec"]
+    [HMLOWCOLOR=RGB values] [HMHIGHCOLOR=RGB values] [HMSHARED={NO* | YES}]
+    [HMSCALE={LINEAR* | SQROOT | SQUARE | QBLEND | RANK | QUANTILE}]
+    [HMCLIP=low high] [HMBINS=n] [HMGROUP={ALL* | ROWS | COLUMNS}]
     [APPLYTO={BOTH* | LABELS | DATACELLS| True/False expression}]
+    [TOPN=n] [BOTTOMN=n] [TOPNGROUP={ALL* | ROWS | COLUMNS}]
 [/HELP].
 
 Operating on the specified set of rows or columns, you can
@@ -69,6 +92,9 @@ SUBTYPE="*" processes tables regardless of subtype.
 
 By default, the immediately preceding procedure output is processed.  Specify
 PROCESS=ALL to process all existing tables matching the specified subtypes.
+PROCESS=LAST processes the output of the last LASTPROCS procedures.  LASTPROCS
+defaults to 1, which is the same as PRECEDING.
+FIRSTMATCH=YES processes only the last matching table in the scanned output.
 
 SELECT is a list of one or more data columns or rows to modify.
 They can be specified by number, counting from zero, or by the text at the 
@@ -86,6 +112,9 @@ used to match patterns.  For example, the pattern
 "^Sig"
 would match any label starting with Sig.
 
+IGNORECASE=YES matches label text and regular expressions without regard
+to case.
+
 By default, when selecting by the row or column header text, the lowest or
 innermost text is tested.  LEVEL can be specified to use outer layers
 of the labels.  LEVEL=-1, the default, is the innermost layer.  More negative
@@ -99,6 +128,47 @@ numbers always count at the innermost level.
 
 Use PRINTLABELS=TRUE to display the full label structure of selected tables
 in the specified dimension in order to assist in specifying the level.
+At most 1000 labels are listed by one command.  Repeated messages in the
+Information table are shown once with a count.
+
+LABELSFILE="filespec" writes the label listing to a file instead of the
+Viewer, with no limit on the number of labels.  Each table is identified by
+its Viewer item number, subtype, and dimension.  If the name ends with .csv,
+the file is CSV with one line per label; otherwise it is JSON lines with one
+object per table.  LABELSFILE implies PRINTLABELS=YES.
+
+KEEPSESSION=YES keeps the connection to the Viewer open after the command
+so that later MODIFY TABLES commands in the job start faster.  The connection
+is closed at the end of the job, after an error, or by a command without
+KEEPSESSION=YES.
+
+MAXTIME and MAXTABLES limit the elapsed time in seconds and the number of
+tables processed by the command.  When a limit is reached, the command stops
+before the next table and reports this in the Information table.  A later
+command with RESUME=YES continues from that point instead of from the end
+of the Viewer.
+
+JOURNAL=YES records the prior values of the cell and label properties that
+the command changes.  A later command with REVERT=YES restores the tables
+changed by the last journaled command, limited to the tables matched by its
+SUBTYPE and PROCESS settings, and does nothing else.  Properties already at
+their prior values are not written.  Tablelooks are not recorded, and
+reverting a hide shows all the hidden labels at that level.  The journals
+of the last five journaled commands are kept for the session, with one entry
+for each changed property, so older commands cannot be reverted.  A table
+is recognized by its Viewer position, subtype, and title.
+
+DIFF=YES journals the command and compares it, table by table, with the
+last journaled command.  Only the properties whose values differ are
+written, and properties changed by that command but not by this one are
+restored.  Use it when adjusting a specification on the same output.
+
+CHUNKSIZE styles very large tables that many data rows at a time, making
+the pending writes after each block so that buffers stay small.  Heatmap
+scales still cover the whole selection.  With HMSCALE=RANK or QUANTILE or
+with HMCLIP, the ranks and percentiles are then estimated from a sample of
+100,000 values in each scaling group, so groups larger than that may be
+colored slightly differently than without CHUNKSIZE.
 
 Note that hiding a category hides that category in all dimensions.
 
@@ -112,6 +182,9 @@ styles are specified.
 Specify WIDTHS=list of widths to set the width of the specified
 columns to the specified values in points (one point = 1/72 inch).
 If WIDTHS specifies a single value, it is applied to all selected columns.
+WIDTHS=AUTO sets each selected column to fit its formatted values and the
+longest word of its innermost label, using approximate character widths for
+the cell font.  AUTO can be used with REGEXP.
 WIDTHS cannot be used with DIMENSION=ROWS.
 
 ROWLABELS selects labels in the row dimension.  It only accepts numbers;
@@ -121,6 +194,12 @@ ROWLABELWIDTHS, which is a set of widths to apply to the row labels.
 The STYLES subcommand sets styles for the text in each selected row or
 column and/or applies a tableLook
 TLOOK specifies a tablelook to be applied before other styling.
+The file is checked once per session unless it changes.  With KEEPSESSION=YES,
+a table that an earlier command left exactly as this tablelook set it is not
+changed again.  A table is recognized by its Viewer position, subtype, and
+title.  Other changes to it, such as by OUTPUT MODIFY or by editing, are not
+detected, so specify KEEPSESSION=NO on the earlier command if tables are
+restyled in between.
 
 TEXTSTYLE sets the text style to
 REGULAR, BOLD, ITALIC, or BOLDITALIC.
@@ -135,6 +214,24 @@ Besides the built in functionality, you can create a Python function to be calle
 cell.  CUSTOMFUNCTION gives the module and function name in quotes and separated by ".".
 See module customstylefunctions for documentation on how to write such functions.
 
+HMLOWCOLOR and HMHIGHCOLOR color the selected data cells as a heatmap.
+By default, each table is scaled by its own range of values.  HMSHARED=YES
+scales all the processed tables by the combined range, so colors are
+comparable across tables.  The tables are read twice: once to find the range
+and once to apply the colors.  HMSHARED cannot be combined with MAXTIME,
+MAXTABLES, or RESUME.
+
+HMSCALE=RANK colors each cell by the rank of its value rather than its
+position in the range, so a single outlier such as a total does not wash out
+the other colors.  HMSCALE=QUANTILE groups the ranks into HMBINS equal-count
+bins, 5 by default, and colors each bin.  HMCLIP=low high, e.g., HMCLIP=2 98,
+limits the range for the other scales to those percentiles of the values.
+Values beyond the limits get the end colors.
+
+HMGROUP=ROWS or COLUMNS scales each row or column of the selected cells
+against its own values instead of the whole selection.  It cannot be
+combined with HMSHARED.
+
 Custom functions can have user-specified parameters written in Python notation.  For example,
 "myfuncs.decorate(p1=100, p2='xyz')"
 specifies parameters p1 and p2 with values 100 and 'xyz'.  Details on retrieving these values
@@ -159,8 +256,18 @@ All cells in the row or column should be numeric.
 Date formats cannot be used.
 If the expression cannot be evaluated for a cell, it is considered False.
 
-You can only operate on one dimension with a single command, but you can use as many
-commands as needed.
+TOPN and BOTTOMN restrict the data cell styles to the n largest and/or
+n smallest values among the selected cells that qualify under APPLYTO
+and the significance settings.  Nonnumeric cells are never chosen.
+TOPNGROUP=ALL, the default, ranks over the whole selection.  ROWS or COLUMNS
+ranks within each row or column, so each one gets its own n cells.
+Label styles are not affected.
+
+To operate on both dimensions with a single command, use ROWSELECT and COLSELECT
+instead of SELECT and DIMENSION.  Each table is then read only once.
+Widths, row label widths, and TLOOK are applied once.  Heatmaps, TOPN, and
+BOTTOMN cannot be used with both ROWSELECT and COLSELECT.
+You can use as many commands as needed.
 
 /HELP displays this text and does nothing else.
 
@@ -197,54 +304,79 @@ SPSS MODIFY TABLES SUBTYPE='Crosstabulation' SELECT="Std. Residual"
 DIMENSION = ROWS
 /STYLES TEXTSTYLE=BOLD APPLYTO="abs(x) > 2".
 """
+# the templates are built once.  Run makes a new Syntax from them for each command,
+# since a Syntax object keeps the parameters it has parsed
+TEMPLATES = [
+    Template("SUBTYPE", subc="",  ktype="str", var="subtype", islist=True),
+    Template("PROCESS", subc="", ktype="str", var="process", islist=False),
+    Template("LASTPROCS", subc="", ktype="int", var="lastprocs", vallist=(1,)),
+    Template("FIRSTMATCH", subc="", ktype="bool", var="firstmatch"),
+    Template("SELECT", subc="",  ktype="literal", var="select", islist=True),
+    Template("ROWSELECT", subc="",  ktype="literal", var="rowselect", islist=True),
+    Template("COLSELECT", subc="",  ktype="literal", var="colselect", islist=True),
+    Template("REGEXP", subc="", ktype="bool", var="regexp"),
+    Template("IGNORECASE", subc="", ktype="bool", var="ignorecase"),
+    Template("DIMENSION", subc="", ktype="str", var="dimension"),
+    Template("LEVEL", subc="", ktype="int", var= "level"),
+    Template("HIDE", subc="", ktype="bool", var="hide", islist=False),
+    Template("PRINTLABELS", subc="", ktype="bool", var="printlabels"),
+    Template("LABELSFILE", subc="", ktype="literal", var="labelsfile"),
+    Template("COUNTINVIS", subc="", ktype="bool", var="countinvis"),
+    Template("SIGCELLS", subc="", ktype="str", var="sigcells"),
+    Template("SIGLEVELS", subc="", ktype="str", var="siglevels",
+        vallist=["both", "upper", "lower"]),
+    Template("KEEPSESSION", subc="", ktype="bool", var="keepsession"),
+    Template("MAXTIME", subc="", ktype="float", var="maxtime", vallist=(0,)),
+    Template("MAXTABLES", subc="", ktype="int", var="maxtables", vallist=(1,)),
+    Template("RESUME", subc="", ktype="bool", var="resume"),
+    Template("JOURNAL", subc="", ktype="bool", var="journal"),
+    Template("REVERT", subc="", ktype="bool", var="revert"),
+    Template("DIFF", subc="", ktype="bool", var="diff"),
+    Template("CHUNKSIZE", subc="", ktype="int", var="chunksize", vallist=(1,)),
+    
+    Template("WIDTHS", subc="WIDTHS", ktype="str", var="widths", islist=True),
+    Template("ROWLABELS", subc="WIDTHS", ktype="str", var="rowlabels", islist=True),
+    Template("ROWLABELWIDTHS", subc="WIDTHS", ktype="int", var="rowlabelwidths", islist=True),
+    
+    Template("TLOOK", subc="STYLES", ktype="literal", var="tlook"),
+    Template("TEXTSTYLE", subc="STYLES", ktype="str", var="textstyle", islist=False),
+    Template("TEXTCOLOR", subc="STYLES", ktype="int", var="textcolor", vallist=(0, 255), islist=True),
+    Template("BACKGROUNDCOLOR", subc="STYLES", ktype="int", var="bgcolor", vallist=(0, 255), islist=True),
+    Template("APPLYTO", subc="STYLES", ktype="literal", var="applyto", islist=False),
+    Template("CUSTOMFUNCTION", subc="STYLES", ktype="literal", var="customfunction", islist=True),
+    Template("HMLOWCOLOR", subc="STYLES", ktype="int", var="hmlocolor", vallist=(0, 255), islist=True),
+    Template("HMHIGHCOLOR", subc="STYLES", ktype="int", var="hmhicolor", vallist=(0, 255), islist=True),
+    Template("HMSCALE", subc="STYLES", ktype="str", var="hmscale",
+        vallist=["linear", "sqroot", "square", "qblend", "rank", "quantile"]),
+    Template("HMTRANSPARENT", subc="STYLES", ktype="bool", var="hmtransparent"),
+    Template("HMAUTOCOLOR", subc="STYLES", ktype="bool", var="hmautocolor"), 
+    Template("HMSHARED", subc="STYLES", ktype="bool", var="hmshared"),
+    Template("HMCLIP", subc="STYLES", ktype="float", var="hmclip", vallist=(0, 100), islist=True),
+    Template("HMBINS", subc="STYLES", ktype="int", var="hmbins", vallist=(2,)),
+    Template("HMGROUP", subc="STYLES", ktype="str", var="hmgroup",
+        vallist=["all", "rows", "columns"]),
+    Template("USEABS", subc="STYLES", ktype="bool", var="useabs"), 
+    Template("TOPN", subc="STYLES", ktype="int", var="topn", vallist=(1,)),
+    Template("BOTTOMN", subc="STYLES", ktype="int", var="bottomn", vallist=(1,)),
+    Template("TOPNGROUP", subc="STYLES", ktype="str", var="topngroup",
+        vallist=["all", "rows", "columns"]),
+    
+    Template("HELP", subc="", ktype="bool")]
+
 def Run(args):
     """Execute the MODIFY TABLES extension command"""
 
     args = args[list(args.keys())[0]]
 
-    oobj = Syntax([
-        Template("SUBTYPE", subc="",  ktype="str", var="subtype", islist=True),
-        Template("PROCESS", subc="", ktype="str", var="process", islist=False),
-        Template("SELECT", subc="",  ktype="literal", var="select", islist=True),
-        Template("REGEXP", subc="", ktype="bool", var="regexp"),
-        Template("DIMENSION", subc="", ktype="str", var="dimension"),
-        Template("LEVEL", subc="", ktype="int", var= "level"),
-        Template("HIDE", subc="", ktype="bool", var="hide", islist=False),
-        Template("PRINTLABELS", subc="", ktype="bool", var="printlabels"),
-        Template("COUNTINVIS", subc="", ktype="bool", var="countinvis"),
-        Template("SIGCELLS", subc="", ktype="str", var="sigcells"),
-        Template("SIGLEVELS", subc="", ktype="str", var="siglevels",
-            vallist=["both", "upper", "lower"]),
-        
-        Template("WIDTHS", subc="WIDTHS", ktype="int", var="widths", vallist=(0,), islist=True),
-        Template("ROWLABELS", subc="WIDTHS", ktype="str", var="rowlabels", islist=True),
-        Template("ROWLABELWIDTHS", subc="WIDTHS", ktype="int", var="rowlabelwidths", islist=True),
-        
-        Template("TLOOK", subc="STYLES", ktype="literal", var="tlook"),
-        Template("TEXTSTYLE", subc="STYLES", ktype="str", var="textstyle", islist=False),
-        Template("TEXTCOLOR", subc="STYLES", ktype="int", var="textcolor", vallist=(0, 255), islist=True),
-        Template("BACKGROUNDCOLOR", subc="STYLES", ktype="int", var="bgcolor", vallist=(0, 255), islist=True),
-        Template("APPLYTO", subc="STYLES", ktype="literal", var="applyto", islist=False),
-        Template("CUSTOMFUNCTION", subc="STYLES", ktype="literal", var="customfunction", islist=True),
-        Template("HMLOWCOLOR", subc="STYLES", ktype="int", var="hmlocolor", vallist=(0, 255), islist=True),
-        Template("HMHIGHCOLOR", subc="STYLES", ktype="int", var="hmhicolor", vallist=(0, 255), islist=True),
-        Template("HMSCALE", subc="STYLES", ktype="str", var="hmscale",
-            vallist=["linear", "sqroot", "square", "qblend"]),
-        Template("HMTRANSPARENT", subc="STYLES", ktype="bool", var="hmtransparent"),
-        Template("HMAUTOCOLOR", subc="STYLES", ktype="bool", var="hmautocolor"), 
-        Template("USEABS", subc="STYLES", ktype="bool", var="useabs"), 
-        
-        Template("HELP", subc="", ktype="bool")])
-
     # A HELP subcommand overrides all else
     if "HELP" in args:
         #print helptext
         helper()
     else:
         ###import cProfile
-        ###cProfile.runctx("import extension, modifytables;extension.processcmd(oobj, args, modifytables.modify)",
+        ###cProfile.runctx("import extension, modifytables;extension.processcmd(Syntax(TEMPLATES), args, modifytables.modify)",
             ###globals(), locals())
-        processcmd(oobj, args, modifytables.modify)
+        processcmd(Syntax(TEMPLATES), args, modifytables.modify)
 
 def helper():
     """open html help in default browser window
@@ -25,6 +25,12 @@ more.datacells
 are the corresponding parts of the pivot table.
 more.thetable is the pivot table object itself.  This might be used for apis such as ClearSelection that
 require the table object.
+more.rowsummary(start, stop) returns per-row aggregates of data columns start to stop-1
+(default all columns) with methods rowmax(i), count(i), and isblank(i).  It is computed once per
+table, so functions called for every cell should use it rather than reading the whole row each time.
+more.hiddenrows is a set that functions can use to record rows of the current table already hidden.
+more.deferred(key, flush, factory) returns an accumulator for the current table.  flush(accumulator, more)
+is called after all the cells of the table have been styled.  See FormatBatch below for an example.
 Their main use is for doing something to a part of the table not being passed in the call.  See the Regression
 coefficient example below.
 
@@ -57,17 +63,25 @@ __version__ = "1.9.2"
 
 # 21-oct-2015 Add exception protection to SetNumericFormatAndDecimals
 # 06-aug-2016 Add spreadsig function to move new style significance levels to their own row
+# 19-oct-2026 sortTable: multiple sort keys, preserve formats, rewrite only rows that move
+# 19-oct-2026 HideRowBasedOnValues and hideBlankRow use the cached row summary
+# 19-oct-2026 reletter uses a translation table and skips unchanged cells
+# 19-oct-2026 decimal, format, rounding, and leading zero functions batch their changes per table
+# 19-oct-2026 roundToFormat rounds the batch together and only rewrites values that change
+# 19-oct-2026 makeSigCoefsBold and colorCrosstabResiduals use the cached format parsers
 
 
 
 # function RGB takes a list of three values and returns the RGB value
 # function floatex decodes a numeric string value to its float value taking the cell format into account
+# function decodevalue does the same with a parser that is built once for each format
 
 
 import SpssClient   # for text constants
-from modifytables import RGB
+from modifytables import RGB, decodevalue
 from extension import floatex  # strings to floats
-import sys
+import sys, re
+from array import array
 
 #debugging (move this code appropriately for repeated debugging)
 #import wingdbstub
@@ -252,7 +266,7 @@ def makeSigCoefsBold(obj, i, j, numrows, numcols, section, more):
     # a little misuse protection
     if section != 'datacells':
         return
-    sig = floatex(obj.GetValueAt(i, 4), obj.GetNumericFormatAt(i, 4))
+    sig = decodevalue(obj.GetValueAt(i, 4), obj.GetNumericFormatAt(i, 4))
     if sig <= 0.05:
         obj.SetTextStyleAt(i,0, SpssClient.SpssTextStyleTypes.SpssTSBold)
         more.rowlabelarray.SetTextStyleAt(i, 3, SpssClient.SpssTextStyleTypes.SpssTSBold)
@@ -270,7 +284,7 @@ def makeSigCoefsBold(obj, i, j, numrows, numcols, section, more):
 def colorCrosstabResiduals(obj, i, j, numrows, numcols, section, more,custom):
     if section == "datacells":
         try:
-            if abs(floatex(obj.GetValueAt(i,j))) >= custom.get("thresh", 2.0):
+            if abs(decodevalue(obj.GetValueAt(i,j), obj.GetNumericFormatAt(i,j))) >= custom.get("thresh", 2.0):
                 for k in range(custom.get("number", 1) + 1):
                     obj.SetBackgroundColorAt(i - k, j, RGB((255,0,0)))
                 obj.SetBackgroundColorAt(i-1, j, RGB((255,0,0))) 
@@ -279,6 +293,98 @@ def colorCrosstabResiduals(obj, i, j, numrows, numcols, section, more,custom):
 
         
         
+# The decimal, format, rounding, and leading zero functions below record the cells
+# they are called for in a FormatBatch and make the changes after all the cells of the table
+# have been styled.  Format and decimal changes are made first, grouped by the current
+# format of the cells, and only cells whose format actually changes are written.
+# Rounding and leading zeros then use the new decimals.
+
+class FormatBatch(object):
+    """Pending format changes for the data cells of one table"""
+    
+    def __init__(self):
+        self.targets = {}   # (i, j) -> [format or None, decimals or None]
+        self.rounding = []
+        self.leadingzero = []
+        
+    def settarget(self, i, j, format=None, decimals=None):
+        target = self.targets.setdefault((i, j), [None, None])
+        if format is not None:
+            target[0] = format
+        if decimals is not None:
+            target[1] = decimals
+        
+def formatbatch(more):
+    """Return the FormatBatch for the current table"""
+    
+    return more.deferred("formatbatch", flushformats, FormatBatch)
+
+def flushformats(batch, more):
+    """Make the format changes recorded in batch"""
+    
+    obj = more.datacells
+    groups = {}
+    for (i, j), (format, decimals) in batch.targets.items():
+        try:
+            current = (obj.GetNumericFormatAt(i, j), obj.GetHDecDigitsAt(i, j))
+        except:
+            continue   # a short row
+        groups.setdefault((current, format, decimals), []).append((i, j))
+    for (current, format, decimals), cells in groups.items():
+        # the target is computed once for each group of cells with the same current format
+        if format is None:
+            format = current[0]
+        if decimals is None:
+            decimals = current[1]
+        if format != current[0] and decimals != current[1]:
+            for i, j in cells:
+                try:
+                    obj.SetNumericFormatAtWithDecimal(i, j, format, decimals)
+                except:
+                    pass
+        elif format != current[0]:
+            for i, j in cells:
+                obj.SetNumericFormatAt(i, j, format)
+        elif decimals != current[1]:
+            for i, j in cells:
+                obj.SetHDecDigitsAt(i, j, decimals)
+    if batch.rounding:
+        roundcells(obj, batch.rounding)
+    for i, j in batch.leadingzero:
+        value = obj.GetUnformattedValueAt(i,j)
+        decimals = obj.GetHDecDigitsAt(i,j)
+        try:
+            value2 = str(round(float(value), decimals)).replace(".", ",")  # comma locale
+            
+            obj.SetValueAt(i,j, chr(160) + value2)  # a NBSP is used to prevent conversion to a number
+            obj.SetHAlignAt(i,j, SpssClient.SpssHAlignTypes.SpssHAlRight)
+        except:
+            pass
+
+def roundcells(obj, cells):
+    """Round the values of cells to their displayed decimals, rewriting only values that change
+    
+    cells is a list of (i, j) data cell coordinates"""
+    
+    # read the numeric cells and their decimals first, then round them all together
+    numeric = []
+    values = array('d')
+    decimals = array('i')
+    for i, j in cells:
+        try:
+            value = float(obj.GetUnformattedValueAt(i,j))
+        except:
+            continue   # sysmis, blank, and nonnumeric values are not affected
+        if value != value:
+            continue   # nan
+        numeric.append((i, j))
+        values.append(value)
+        decimals.append(obj.GetHDecDigitsAt(i,j))
+    rounded = [round(v, d) for v, d in zip(values, decimals)]
+    for (i, j), value, newvalue in zip(numeric, values, rounded):
+        if newvalue != value:
+            obj.SetValueAt(i,j, str(newvalue))
+        
 # The next function sets the selected cells to have two decimal places.
 # Usage example:
 # FREQUENCIES var.
@@ -292,7 +398,7 @@ def SetTwoDecimalPlaces(obj, i, j, numrows, numcols, section, more):
     
     if section != 'datacells':
         return
-    obj.SetHDecDigitsAt(i, j, 2)
+    formatbatch(more).settarget(i, j, decimals=2)
     
 # The next function is similar but takes an optional decimals parameter
 # Usage example:
@@ -308,8 +414,7 @@ def SetDecimalPlaces(obj, i, j, numrows, numcols, section, more, custom):
     
     if section != 'datacells':
         return
-    decimals = custom.get("decimals", 2)
-    obj.SetHDecDigitsAt(i, j, decimals)
+    formatbatch(more).settarget(i, j, decimals=custom.get("decimals", 2))
     
 def setLeadingZero(obj, i, j, numrows, numcols, section, more):
     """Set leading zero on cell by converting to string and prepending a zero
@@ -318,15 +423,7 @@ def setLeadingZero(obj, i, j, numrows, numcols, section, more):
     
     if section != 'datacells':
         return
-    value = obj.GetUnformattedValueAt(i,j)
-    decimals = obj.GetHDecDigitsAt(i,j)
-    try:
-        value2 = str(round(float(value), decimals)).replace(".", ",")  # comma locale
-        
-        obj.SetValueAt(i,j, chr(160) + value2)  # a NBSP is used to prevent conversion to a number
-        obj.SetHAlignAt(i,j, SpssClient.SpssHAlignTypes.SpssHAlRight)
-    except:
-        pass
+    formatbatch(more).leadingzero.append((i, j))
 
 # The next function changes the selected cell values.  The full-precision value is
 # changed to the value with decimals as displayed.  Thus the cell value in edit mode
@@ -347,13 +444,7 @@ def roundToFormat(obj, i, j, numrows, numcols, section, more):
     
     if section != 'datacells':
         return
-    value = obj.GetUnformattedValueAt(i,j)
-    decimals = obj.GetHDecDigitsAt(i,j)
-    try:
-        value = round(float(value), decimals)
-        obj.SetValueAt(i,j, str(value))
-    except:
-        pass
+    formatbatch(more).rounding.append((i, j))
 
 
 # The next function sets the format of a data cell.
@@ -369,7 +460,7 @@ def SetNumericFormat(obj, i, j, numrows, numcols, section, more, custom):
     custom parameter is format"""
     
     if section == "datacells":
-        obj.SetNumericFormatAt(i, j, custom.get("format", "#.#"))
+        formatbatch(more).settarget(i, j, format=custom.get("format", "#.#"))
                                
 #The next function is the same as SetNumericFormats except that it
 # has a parameter for the number of decimals
@@ -383,13 +474,9 @@ def SetNumericFormatAndDecimals(obj, i, j, numrows, numcols, section, more, cust
     decimals=n                (default is 2)  """
 
     # If a pivot table has a short row such as with FREQUENCIES, an exception may
-    # be raised on such a cell
+    # be raised on such a cell.  flushformats skips those cells
     if section == "datacells":
-        try:
-            obj.SetNumericFormatAtWithDecimal(i, j, custom.get("format", "#.#"),
-                custom.get("decimals", 2))
-        except:
-            pass
+        formatbatch(more).settarget(i, j, custom.get("format", "#.#"), custom.get("decimals", 2))
     
 # The next function can be used to hide portions of tables where there is a sequence of numbered
 # repetitions of blocks.  For example, running REGRESSION with stepwise methods or other blocks
@@ -492,20 +579,30 @@ def SetCellMargins(obj, i, j, numrows, numcols, section, more, custom):
 
 def sortTable(obj, i, j, numrows, numcols, section, more, custom):
     """Sort the rows of the table according to the selected column values
-    Cell formats are NOT updated, so the formats for all cells in a column
-    should be the same.
+    Cell values and formats move with their rows.
     
     Since it is not practical to move table footnotes along with the cell values,
     all footnotes are hidden.
     
-    custom parameter is direction ('a', the default, or 'd')"""
+    custom parameters are
+    direction ('a', the default, or 'd')
+    keys - optional list of column numbers to sort by, most important first.
+        The default is the selected column.
+    directions - optional list of 'a' or 'd' for each key.  The default is direction
+        for all keys.
+    The sort is stable, so rows with equal keys keep their order.
+    Numeric values sort before text values."""
     
     if not section == "datacells":
         return
     
     direction = custom.get("direction", "a")
-    if not direction in ['a', 'd']:
-        print("direction must be 'a' or 'd'")
+    keys = custom.get("keys", [j])
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    directions = custom.get("directions", len(keys) * [direction])
+    if len(directions) != len(keys) or any(d not in ['a', 'd'] for d in directions):
+        print("direction must be 'a' or 'd' for each sort key")
         raise ValueError
     
     PvtMgr = more.thetable.PivotManager()
@@ -514,41 +611,52 @@ def sortTable(obj, i, j, numrows, numcols, section, more, custom):
         print("Cannot sort table unless there is exactly one row dimension")
         raise ValueError
 
-    col = j   # sorting column
-    colvalues = []
-
-    # store each row of pivot table as a list item consisting of the row label, the unformatted cell value
-    # as a number if possible followed by the formatted string values
+    # snapshot the row labels and the cell values and formats once
+    labels = [more.rowlabelarray.GetValueAt(i,1) for i in range(numrows)]
+    cells = []
     for i in range(numrows):
-        cval = []
-        cval.append(more.rowlabelarray.GetValueAt(i,1))   # row label
-        # append sorting key after trying to convert to a number
-        kv = obj.GetUnformattedValueAt(i, col)
-        try:
-            kv = float(kv)
-        except:
-            pass
-        cval.append(kv)
-        
+        row = []
         for j in range(numcols):
-            cval.append(obj.GetUnformattedValueAt(i, j))
             nf = obj.GetNumericFormatAt(i,j)
             if nf == '.-.$... ':
                 nf = "$#,###.##"
-            cval.append(nf)
-        colvalues.append(cval)
-    colvalues.sort(key=lambda arow: arow[1], reverse = direction == "d")
+            try:
+                decimals = obj.GetHDecDigitsAt(i,j)
+            except:
+                decimals = None
+            row.append((obj.GetUnformattedValueAt(i, j), nf, decimals))
+        cells.append(row)
+
+    def sortkey(col):
+        # numbers sort before text so that mixed columns still compare
+        def f(row):
+            kv = cells[row][col][0]
+            try:
+                return (0, float(kv), "")
+            except:
+                return (1, 0., kv)
+        return f
 
-    for i in range(numrows):
-        more.rowlabelarray.SetValueAt(i, 1, colvalues[i][0])
-        
-    for i in range(numrows):
-        for j in range(0, numcols):
+    # stable sorts from the least to the most important key give the multi-key order
+    order = list(range(numrows))
+    for col, d in reversed(list(zip(keys, directions))):
+        order.sort(key=sortkey(col), reverse = d == "d")
+
+    # write back only the rows that moved
+    for i, source in enumerate(order):
+        if source == i:
+            continue
+        more.rowlabelarray.SetValueAt(i, 1, labels[source])
+        for j in range(numcols):
+            value, nf, decimals = cells[source][j]
+            try:
+                obj.SetValueAt(i,j, value)
+            except:
+                continue
             try:
-                index = j * 2 + 2
-                obj.SetValueAt(i,j, colvalues[i][index])
-                # for versions prior to 19, not setting the format string
-                #obj.SetNumericFormatAt(i, j, colvalues[i][index + 1])
+                obj.SetNumericFormatAt(i, j, nf)   # not available prior to version 19
+                if decimals is not None:
+                    obj.SetHDecDigitsAt(i, j, decimals)
             except:
                 pass
     # hide all footnotes
@@ -889,6 +997,8 @@ def HideRowBasedOnValues(obj, i, j, numrows, numcols, section, more, custom):
     
     
     if section == 'labels':
+        if i in more.hiddenrows:
+            return
         thresh = float(custom.get("threshold", -1e8))
         numcols = more.datacells.GetNumColumns()
         omitfirst = custom.get("omitfirst", 0)
@@ -896,15 +1006,10 @@ def HideRowBasedOnValues(obj, i, j, numrows, numcols, section, more, custom):
         
         start, stop = 0+omitfirst, numcols-omitlast
         
-        for col in range(start, stop):
-            v = more.datacells.GetUnformattedValueAt(i, col)
-            try:
-                if float(v) > thresh:
-                    break
-            except:
-                pass
-        else:
+        rowmax = more.rowsummary(start, stop).rowmax(i)
+        if rowmax is None or not rowmax > thresh:
             obj.HideLabelsWithDataAt(i,j)
+            more.hiddenrows.add(i)
             
 # The next function takes the first, outermost, row label and makes it the table title.
 # Usage example:
@@ -1002,14 +1107,12 @@ def stripeOddDataRowsAndAlign(obj, i, j, numrows, numcols, section, more):
 def hideBlankRow(obj, i, j, numrows, numcols, section, more):
     """hide rows that appear entirely blank"""
     
-    if not section =="datacells":
+    if not section =="datacells" or i in more.hiddenrows:
         return
-    for c in range(numcols):
-        if obj.GetValueAt(i,c) != "":
-            break
-    else:
+    if more.rowsummary().isblank(i):
         innerlabelcolumn = more.rowlabelarray.GetNumColumns() -1
         more.rowlabelarray.HideLabelsWithDataAt(i, innerlabelcolumn)
+        more.hiddenrows.add(i)
         
 
 # Set horizontal alignment.  Usage example:
@@ -1041,6 +1144,7 @@ def SetAlignment(obj, i, j, numrows, numcols, section, more, custom):
     obj.SetHAlignAt(i,j, custom["align"])
     
 letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+lettersuffix = re.compile(r"\(([A-Z])\)$")   # (X) at the end of a label
 
 # Usage: This function is useful for a Custom Table where the significance
 # table has been merged into the main table. It replace occurrences of
@@ -1073,19 +1177,21 @@ def reletter(obj, i, j, numrows, numcols, section, more, custom):
             newletters = newletters[0]    # no comma separators
         lennew = len(newletters)
         custom["map"] = dict([(a, b) for a, b in zip(letters[:lennew], newletters)])
+        custom["table"] = str.maketrans(custom["map"])
         
     val = obj.GetValueAt(i,j)
     try:
         if section == "labels":
-            if val[-1] == ")" and val[-3] == "(":
-                val = val[:-2] + custom["map"][val[-2]] + val[-1]
-                obj.SetValueAt(i, j, val)
+            mo = lettersuffix.search(val)
+            if mo is None or mo.group(1) not in custom["map"]:
+                return
+            newval = val[:mo.start(1)] + custom["map"][mo.group(1)] + val[mo.end(1):]
         else:
-            if isinstance(val, str):
-                newval = []
-                for c in val:
-                    newval.append(custom["map"].get(c,c))
-                obj.SetValueAt(i,j, "".join(newval))
+            if not isinstance(val, str):
+                return
+            newval = val.translate(custom["table"])
+        if newval != val:   # avoid writes that would not change anything
+            obj.SetValueAt(i, j, newval)
     except:
         pass
     
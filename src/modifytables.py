@@ -42,14 +42,48 @@ __author__ = "SPSS, JKP"
 # 31-may-2022 include Notes tables in table types
 # 06-sep-2022 fix for row width for table with only one row
 # 21-aug-2023 add heatmap option
+# 19-oct-2026 add TOPN and BOTTOMN selection
+# 19-oct-2026 add shared heatmap scale across tables
+# 19-oct-2026 add rank and quantile heatmap scales and percentile clipping
+# 19-oct-2026 add heatmap scaling within rows or columns
+# 19-oct-2026 store heatmap targets in typed arrays
+# 19-oct-2026 add cached per-row data summaries for custom functions
+# 19-oct-2026 defer version check and rarely needed imports, cache resolved custom functions
+# 19-oct-2026 add keepsession to reuse the SpssClient connection across commands
+# 19-oct-2026 add maxtime and maxtables limits and resume
+# 19-oct-2026 add process="last" with lastprocs, and firstmatch
+# 19-oct-2026 count repeated messages, limit printlabels output, build the message table in bulk
+# 19-oct-2026 add labelsfile to write the printlabels listing to a JSON lines or CSV file
+# 19-oct-2026 add rowselect and colselect to operate on both dimensions in one command
+# 19-oct-2026 suspend screen updates for the whole command, including tablelook and widths
+# 19-oct-2026 validate the tablelook once per session and skip tables that already have it
+# 19-oct-2026 add widths=["auto"] to fit column widths to their contents
+# 19-oct-2026 cache compiled selection patterns, match label text through an index, add ignorecase
+# 19-oct-2026 add deferred per-table actions for custom functions
+# 19-oct-2026 decode formatted values with cached per-format parsers
+# 19-oct-2026 add journal and revert
+# 19-oct-2026 add diff mode
+# 19-oct-2026 add chunked styling of large tables
+# 19-oct-2026 identify tables left with a tablelook by subtype and title as well as item number
+# 19-oct-2026 limit the number of journals kept
+# 19-oct-2026 key journals by subtype and title as well as item number
+# 19-oct-2026 restart a kept client session if another script stopped it
 
 import spss, SpssClient
 from extension import floatex, _isseq
-import re, functools, inspect, locale, sys, math
-from collections import namedtuple
-cellinfo = namedtuple("cellinfo", ["row", "col", "value"])
-
-v24ok = int(spss.GetDefaultPlugInVersion()[4:]) >= 240
+import re, sys, atexit, functools
+# inspect, locale, math, heapq, random, and bisect are imported where used
+# so that they are only loaded by commands that need them
+from array import array
+
+_v24ok = None
+def v24ok():
+    """Return True if the plug-in version is at least 24.  The version is only checked once"""
+
+    global _v24ok
+    if _v24ok is None:
+        _v24ok = int(spss.GetDefaultPlugInVersion()[4:]) >= 240
+    return _v24ok
 # debugging
         # makes debug apply only to the current thread
 #try:
@@ -89,15 +123,181 @@ class fColumnLabelArray(object):
             self.item = self.pt.ColumnLabelArray()
         return getattr(self.item, name)
 
+class JournalArray(object):
+    """Wrap a data cell or label array so that changes made through it are recorded in a journal log
+
+    log is a dictionary keyed by (part, api name, i, j) with values [prior value, applied value].
+    Only the first prior value of a property is kept, so a revert needs at most one write for it.
+    The formatted text of a changed cell before the change is kept under the name GetValueAt.
+    widthof, if given, returns the current width of a data column so that ReSizeColumn can be recorded.
+    baseline, if given, is the log of the previous command for the table.  Changes are then
+    only recorded, to be written by PtColumns.applydiff, and Get...At calls return the recorded
+    value of a property or else its value before the previous command, so that the new
+    specification is evaluated against the original table.  This includes formatted values."""
+
+    def __init__(self, item, part, log, widthof=None, baseline=None):
+        self.item = item
+        self.part = part
+        self.log = log
+        self.widthof = widthof
+        self.baseline = baseline
+        self.defer = baseline is not None
+
+    def __getattr__(self, name):
+        api = getattr(self.item, name)
+        if self.defer:
+            if name == "GetValueAt":
+                # formatted text cannot be derived from a recorded value, so a changed cell
+                # shows its text before the previous command
+                def wrapper(i, j):
+                    entry = self.baseline.get((self.part, name, i, j))
+                    return api(i, j) if entry is None else entry[0]
+                self.__dict__[name] = wrapper
+                return wrapper
+            if name.startswith("Get") and name.endswith("At"):
+                setname = "SetValueAt" if name == "GetUnformattedValueAt" else "Set" + name[3:]
+                def wrapper(i, j):
+                    key = (self.part, setname, i, j)
+                    if key in self.log:
+                        return self.log[key][1]
+                    return self.baseline[key][0] if key in self.baseline else api(i, j)
+                self.__dict__[name] = wrapper
+                return wrapper
+        write = (lambda *args: None) if self.defer else api
+        if name == "HideLabelsWithDataAt":
+            def wrapper(i, j):
+                write(i, j)   # only a hide that succeeds is recorded.  See PtColumns.hider
+                self.record(name, i, j, lambda: False, True)
+        elif name == "ReSizeColumn" and self.widthof:
+            def wrapper(col, width):
+                self.record(name, col, None, lambda: self.widthof(col), width)
+                write(col, width)
+        elif name == "SetNumericFormatAtWithDecimal":
+            def wrapper(i, j, format, decimals):
+                self.record("SetNumericFormatAt", i, j, lambda: self.item.GetNumericFormatAt(i, j), format)
+                self.record("SetHDecDigitsAt", i, j, lambda: self.item.GetHDecDigitsAt(i, j), decimals)
+                write(i, j, format, decimals)
+        elif name.startswith("Set") and name.endswith("At") and journalgetter(self.item, name):
+            getter = journalgetter(self.item, name)
+            def wrapper(i, j, value):
+                self.record(name, i, j, lambda: getter(i, j), value)
+                write(i, j, value)
+        else:
+            return api
+        self.__dict__[name] = wrapper   # later calls do not come through __getattr__
+        return wrapper
+
+    def record(self, name, i, j, prior, value):
+        key = (self.part, name, i, j)
+        if key in self.log:
+            self.log[key][1] = value
+            return
+        try:
+            self.log[key] = [prior(), value]
+        except:
+            return   # cannot be recorded, e.g., a short row
+        textkey = (self.part, "GetValueAt", i, j)
+        if j is not None and name != "HideLabelsWithDataAt" and textkey not in self.log:
+            try:
+                self.log[textkey] = [self.item.GetValueAt(i, j), None]
+            except:
+                pass
+
+def journalgetter(item, name):
+    """Return the api that reads the property set by api name or None"""
+
+    if name == "SetValueAt":   # keep full precision
+        return getattr(item, "GetUnformattedValueAt", None) or getattr(item, "GetValueAt", None)
+    return getattr(item, "Get" + name[3:], None)
+
+def revertentry(array, name, i, j, prior):
+    """Restore one journaled property to its prior value if it has changed"""
+
+    try:
+        if name == "GetValueAt":   # formatted text follows from the other properties
+            return
+        if name == "HideLabelsWithDataAt":
+            # there is no api to show a single label, so this shows the hidden labels of that level
+            array.ShowAllLabelsAndDataInDimensionAt(i, j)
+        elif name == "ReSizeColumn":
+            array.ReSizeColumn(i, prior)
+        elif journalgetter(array, name)(i, j) != prior:
+            getattr(array, name)(i, j, prior)
+    except:
+        pass
+
+def hidefallback(key):
+    """Return the journal key of the location PtColumns.hider tries when a hide at key fails"""
+
+    part, name, i, j = key
+    if part == "columnlabels":
+        return (part, name, i - 2, j)
+    return (part, name, i, j - 2)
+
+class Journal(object):
+    """The prior values of the properties changed by one command, by table
+
+    Tables are keyed by PtColumns.tableid, the item number, subtype, and title, so that
+    a table whose item number has shifted is not mistaken for another one.
+
+    baseline, if given, is the journal of the previous command.  The changes are then
+    applied as differences from it."""
+
+    def __init__(self, baseline=None):
+        self.tables = {}
+        self.baseline = baseline
+
+    def table(self, tableid):
+        return self.tables.setdefault(tableid, {})
+
+def revertjournal(matched, info):
+    """Restore the tables in matched that were changed by the last journaled command
+
+    matched is a sequence of (item number, output item) pairs.
+    Properties already at their prior values are not written."""
+
+    if not JOURNALS:
+        info.addrow(_("There is no journal to revert.  Specify JOURNAL=YES on the commands to be reverted."))
+        return
+    journal = JOURNALS[-1]
+    count = 0
+    for itemnumber, item in matched:
+        log = journal.tables.pop((itemnumber, item.GetSubType(), item.GetDescription()), None)
+        if log is None:
+            continue
+        pt = item.GetSpecificType()
+        arrays = {"datacells": fDataCellArray(pt), "rowlabels": fRowLabelArray(pt), "columnlabels": fColumnLabelArray(pt)}
+        pt.SetUpdateScreen(False)
+        try:
+            for (part, name, i, j), (prior, applied) in reversed(list(log.items())):
+                revertentry(arrays[part], name, i, j, prior)
+        finally:
+            pt.SetUpdateScreen(True)
+        count += 1
+    if not journal.tables:
+        JOURNALS.pop()
+    info.addrow(_("Tables reverted: %d") % count)
+
 
 CUSTOMPARAMS={}
+RESOLVED={}    # imported custom functions and their argument counts keyed by module.function
+RESUMEPOINT=None   # index of the next output item to process after a command stopped at a limit
+MAXPRINTLABELS=1000   # maximum number of label cells listed by printlabels in one command
+TLOOKS={}   # validated tablelook files: filespec -> (modification time, full path)
+CHARWIDTHS={}   # approximate character widths as a fraction of the font size, keyed by bold or not
+JOURNALS=[]   # journals of the commands run with journal=True, most recent last
+MAXJOURNALS=5   # older journals are discarded, so they cannot be reverted
 def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='columns',
            level=-1, hide=False, widths=None, rowlabels=None, rowlabelwidths=None,
            textstyle=None, textcolor=None, bgcolor=None, applyto="both", customfunction=None, 
            printlabels=False, regexp=False, tlook=None, countinvis=True,
            sigcells=None, siglevels="both",
            hmlocolor=None, hmhicolor=None, useabs=True, hmscale="linear",
-           hmtransparent=False, hmautocolor=False):
+           hmtransparent=False, hmautocolor=False, topn=None, bottomn=None, topngroup="all",
+           hmshared=False, hmclip=None, hmbins=5, hmgroup="all", keepsession=False,
+           maxtime=None, maxtables=None, resume=False, lastprocs=1, firstmatch=False, labelsfile=None,
+           rowselect=None, colselect=None, ignorecase=False, journal=False, revert=False, diff=False,
+           chunksize=None):
     """Apply a hide or show action to specified columns or rows of the specified subtype or resize columns
 
     subtype is the OMS subtype of the tables to process or a sequence of subtypes
@@ -108,8 +308,28 @@ def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='
     If the value is or can be converted to an integer, it is assumed to be a column number.
     Numeric values are truncated to integers.
     You cannot hide all the items even though this routine will try.
-    process specifies "preceding" to process the output of the preceding command or "all"
+    process specifies "preceding" to process the output of the preceding command, "last"
+    to process the output of the last lastprocs procedures, or "all"
     to process all tables having any of the specified subtypes.
+    If firstmatch is True, only the last matching table is processed.
+    labelsfile is an optional file to receive the printlabels listing instead of the Viewer.
+    It is written as CSV if the name ends with .csv and as JSON lines otherwise.
+    If ignorecase is True, label text and regular expressions are matched without regard to case.
+    If journal is True, the prior values of the cell and label properties changed by the command
+    are recorded.  A later command with revert=True restores the tables, limited to those matched
+    by its subtype and process, that were changed by the last journaled command.  Tablelooks are not recorded.
+    The journals of the last MAXJOURNALS journaled commands are kept for the session.
+    If diff is True, the command is journaled and compared, table by table, with the last journaled
+    command.  Only the properties whose values differ are written, and properties changed by that
+    command but not by this one are restored.  The new journal replaces the old one for those tables.
+    chunksize, if given, is the number of data rows styled at a time.  Pending writes are made
+    after each block, and a heatmap is still scaled over the whole selection.  The rank and
+    quantile scales and clipping then use a sample of at most 100000 values per scaling group,
+    so they are estimates for larger groups.
+    rowselect and colselect can be used instead of select and dimension to operate on
+    rows and columns in the same command.  Each table is then fetched once and both
+    selections are applied in the same screen update window.  Widths, row label widths, and
+    the tablelook apply once.  Heatmaps and topn/bottomn require a single dimension.
     level defaults to the innermost level (-1).  Specify a more negative number to move out or up in
     the label array.  -2, for example, would be the next-to-innermost level.
     When counting columns or rows, count at the innermost level regardless of the level setting.
@@ -119,6 +339,7 @@ def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='
     dimension == 'columns' indicates that columns should be operated on.  dimension == 'rows' specifies rows.
     widths specifies the width or widths to be applied to the selected rows or columns
     If it is a single element, it is used for all specified columns.
+    widths=["auto"] sets each selected column to fit its data values and innermost label.
     Otherwise, it is a sequence of sizes in points of the same length as the select list.
     rowlabels and rowlabelwidths can be specified to set stub (row) widths.  rowlabels can only contain numbers.
     textstyle, textcolor, and bgcolor apply formatting.  colors are specified as three integers for RGB.
@@ -127,6 +348,24 @@ def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='
     the cell value.
 
     customfunction is a list of module.function names of  functions to be called as cells are styled.
+    topn and bottomn restrict the data cell styles to the n largest and/or smallest values
+    in the selection.  topngroup is "all", "rows", or "columns" and determines whether
+    the values are ranked over the whole selection or within each row or column.
+    If hmshared is True, the heatmap scale is computed from the selected cells of all
+    the tables processed rather than separately for each table.  It cannot be combined with
+    maxtime, maxtables, or resume, because the scale needs a pass over all the tables.
+    hmscale can be "linear", "sqroot", "square", "qblend", "rank", or "quantile".
+    hmclip is an optional pair of percentiles, e.g., [2, 98], that limit the heatmap range
+    so that outlying values do not compress the colors of the rest.
+    hmbins is the number of color bins for the quantile scale.
+    hmgroup is "all", "rows", or "columns".  With rows or columns, the heatmap scale
+    is computed separately for each row or column of the selected cells.
+    If keepsession is True, the SpssClient connection and output document are kept
+    open after the command so that later commands in the job can reuse them.  The connection
+    is closed at the end of the job, after an error, or by a command without keepsession.
+    maxtime (seconds) and maxtables limit the work done by the command.  When a limit is reached,
+    processing stops before the next table, and the position is recorded so that a later
+    command with resume=True continues from there instead of from the end of the Viewer.
 
     This function processes the latest item in the designated Viewer: all pivot tables for that instance of
     the procedure are processed according to the subtype specification.
@@ -149,17 +388,22 @@ def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='
         #wingdbstub.debugger.SetDebugThreads({threading.get_ident(): 1})
     #except:
         #pass
-    SpssClient.StartClient()
+    global RESUMEPOINT
+    import time
+    starttime = time.time()
+    session.start()
+    completed = False
+    labelswriter = None
+    c = None
     try:
         info = NonProcPivotTable("INFORMATION", tabletitle=_("Information"))
-        c = PtColumns(select, dimension, level, hide, widths, 
-            rowlabels, rowlabelwidths, textstyle, textcolor, bgcolor, applyto, customfunction, 
-            printlabels,regexp, tlook,
-            sigcells, siglevels, hmlocolor, hmhicolor, useabs, hmscale, hmtransparent, hmautocolor)
-        
-        if sigcells is not None and not v24ok:
-            raise ValueError(_("""Significance highlighting requires at least Statistics version 24"""))
-
+        if process not in ["preceding", "last", "all"]:
+            raise ValueError(_("PROCESS must be PRECEDING, LAST, or ALL"))
+        if process == "last":
+            if lastprocs < 1:
+                raise ValueError(_("LASTPROCS must be at least 1"))
+        else:
+            lastprocs = 1 if process == "preceding" else None   # None scans everything
         if not _isseq(subtype):
             subtype=[subtype]
         # remove white space
@@ -168,23 +412,236 @@ def modify(subtype, select=None,  skiplog=True, process="preceding", dimension='
         subtype = [re.sub(r"""^('|")(.*)\1$""", r"""\2""", st) for st in subtype]
         if "*" in subtype:
             subtype = ["*"]
-        items = SpssClient.GetDesignatedOutputDoc().GetOutputItems()
-        itemcount = items.Size()
-        if skiplog and items.GetItemAt(itemcount-1).GetType() == SpssClient.OutputItemType.LOG:
-            itemcount -= 1
-        for itemnumber in range(itemcount-1, -1, -1):
-            item = items.GetItemAt(itemnumber)
-            if process == "preceding" and item.GetTreeLevel() <= 1:
-                break
-            if item.GetType() in [SpssClient.OutputItemType.PIVOT, SpssClient.OutputItemType.NOTE] and\
-               (subtype[0] == "*" or "".join(item.GetSubType().lower().split()) in subtype):
+        if revert:
+            items = session.outputdoc().GetOutputItems()
+            revertjournal(list(matchingitems(items, subtype, lastprocs, skiplog, None, firstmatch)), info)
+            completed = True
+            return
+        selections = [(select, dimension)]
+        if rowselect or colselect:
+            if select:
+                raise ValueError(_("SELECT cannot be combined with ROWSELECT or COLSELECT"))
+            selections = [(sel, dim) for (sel, dim) in [(colselect, "columns"), (rowselect, "rows")] if sel]
+            if len(selections) > 1 and (hmlocolor or hmhicolor or hmautocolor or topn or bottomn):
+                raise ValueError(_("Heatmaps, TOPN, and BOTTOMN cannot be used with both ROWSELECT and COLSELECT"))
+        c = PtColumns(selections[0][0], selections[0][1], level, hide, widths, 
+            rowlabels, rowlabelwidths, textstyle, textcolor, bgcolor, applyto, customfunction, 
+            printlabels,regexp, tlook,
+            sigcells, siglevels, hmlocolor, hmhicolor, useabs, hmscale, hmtransparent, hmautocolor,
+            topn, bottomn, topngroup, hmshared, hmclip, hmbins, hmgroup, ignorecase)
+        # a row selection alongside a column selection shares the table arrays with c.
+        # Widths, row label widths, and the tablelook have already been applied by c, so the
+        # row selection is only needed if the command hides or styles.  Otherwise it would
+        # default to hiding the rows
+        rowaction = c.hide or any([textstyle, textcolor, bgcolor, customfunction])
+        others = [PtColumns(sel, dim, level, hide, None, 
+            None, None, textstyle, textcolor, bgcolor, applyto, customfunction, 
+            printlabels,regexp, None,
+            sigcells, siglevels, hmlocolor, hmhicolor, useabs, hmscale, hmtransparent, hmautocolor,
+            topn, bottomn, topngroup, hmshared, hmclip, hmbins, hmgroup, ignorecase) for (sel, dim) in selections[1:]
+            if rowaction]
+        if hmshared and (maxtime is not None or maxtables is not None or resume):
+            # the range scan covers every table, so a stopped command would color the rest on another scale
+            raise ValueError(_("HMSHARED cannot be combined with MAXTIME, MAXTABLES, or RESUME"))
+        if chunksize is not None:
+            if chunksize < 1:
+                raise ValueError(_("CHUNKSIZE must be at least 1"))
+            for spec in [c] + others:
+                spec.chunksize = chunksize
+        if diff:
+            c.journal = Journal(JOURNALS[-1] if JOURNALS else None)
+        elif journal:
+            c.journal = Journal()
+        if sigcells is not None and not v24ok():
+            raise ValueError(_("""Significance highlighting requires at least Statistics version 24"""))
+        if labelsfile:
+            labelswriter = LabelsWriter(labelsfile)
+            for spec in [c] + others:
+                spec.printlabels = True
+                spec.labelswriter = labelswriter
+
+        items = session.outputdoc().GetOutputItems()
+        start = None
+        if resume:
+            if RESUMEPOINT is None or RESUMEPOINT >= items.Size():
+                info.addrow(_("There is no resume point from a previous command.  No tables were processed."))
+                items = None
+            else:
+                start = RESUMEPOINT
+        RESUMEPOINT = None
+        if items is not None and c.hmshared:
+            # first pass: accumulate the heatmap range over all the matching tables
+            for itemnumber, item in matchingitems(items, subtype, lastprocs, skiplog, start, firstmatch):
+                c.thetable = item.GetSpecificType()
+                if not countinvis:
+                    set23(c.thetable)
+                c.scanaction(c.thetable)
+        tablecount = 0
+        if items is not None:
+            for itemnumber, item in matchingitems(items, subtype, lastprocs, skiplog, start, firstmatch):
+                if (maxtables is not None and tablecount >= maxtables) or \
+                   (maxtime is not None and time.time() - starttime >= maxtime):
+                    RESUMEPOINT = itemnumber
+                    info.addrow(_("Processing stopped at a MAXTIME or MAXTABLES limit after %d tables.  Specify RESUME=YES to continue.")
+                        % tablecount)
+                    break
                 c.thetable = item.GetSpecificType()
+                c.tableid = (itemnumber, item.GetSubType(), item.GetDescription())
                 if not countinvis:
                     set23(c.thetable)
-                c.applyaction(c.thetable, info) 
+                c.applyaction(c.thetable, info, others) 
+                tablecount += 1
+        completed = True
     finally:
+        if c is not None:
+            c.restorescreen()
+            baseline = c.journal is not None and c.journal.baseline
+            if baseline and not baseline.tables:
+                JOURNALS.remove(baseline)
+            if c.journal is not None and c.journal.tables:
+                JOURNALS.append(c.journal)
+                del JOURNALS[:-MAXJOURNALS]
         info.generate()
-        SpssClient.StopClient()
+        if labelswriter:
+            labelswriter.close()
+        if not (keepsession and completed):
+            session.stop()
+
+class ClientSession(object):
+    """Manage the SpssClient connection and the designated output document
+
+    The connection can be kept open across commands.  The cached document is
+    revalidated on each use, since the designated Viewer can change between commands."""
+
+    def __init__(self):
+        self.active = False
+        self.doc = None
+        self.registered = False
+        # tableid -> (tablelook, modification time) for tables left as the look set them.
+        # A table must match in subtype and title too, since item numbers shift if items are deleted
+        self.looks = {}
+
+    def start(self):
+        """Start the client unless a session is already open"""
+
+        if not self.active:
+            SpssClient.StartClient()
+            self.active = True
+            self.doc = None
+            if not self.registered:
+                atexit.register(self.stop)   # close a kept session at the end of the job
+                self.registered = True
+
+    def outputdoc(self):
+        """Return the designated output document, reusing the cached one if it is still designated"""
+
+        if self.doc is not None:
+            try:
+                if self.doc.IsDesignatedOutputDoc():
+                    return self.doc
+            except:
+                # the document has been closed, or another script stopped the client
+                self.active = False
+                self.start()
+        self.doc = SpssClient.GetDesignatedOutputDoc()
+        self.looks = {}
+        return self.doc
+
+    def stop(self):
+        """Stop the client if a session is open"""
+
+        self.doc = None
+        self.looks = {}
+        if self.active:
+            self.active = False
+            try:
+                SpssClient.StopClient()
+            except:
+                pass
+
+session = ClientSession()
+
+CELLMARGIN = 4   # points allowed on each side of a fitted column
+
+def charwidths(bold):
+    """Return a dictionary of approximate character widths as a fraction of the font size
+
+    The table is built once per style.  Characters not in it are taken as average width."""
+
+    if bold not in CHARWIDTHS:
+        widths = {}
+        for chars, width in [("il.,:;|!'`", .28), ("fjrtI()[]-/ ", .34), ("0123456789$+=<>#_*", .56),
+            ("abcdeghknopqsuvxyz?", .52), ("ABCDEFGHJKLNOPQRSTUVXYZ", .67), ("mwMW%@&", .85)]:
+            for c in chars:
+                widths[c] = width * (1.07 if bold else 1.)
+        CHARWIDTHS[bold] = widths
+    return CHARWIDTHS[bold]
+
+def textwidth(text, size, bold=False):
+    """Return the approximate width in points of text in a font of size points"""
+
+    widths = charwidths(bold)
+    average = .56 * (1.07 if bold else 1.)
+    return size * sum(widths.get(c, 1. if ord(c) >= 0x2e80 else average) for c in text)
+
+@functools.lru_cache(maxsize=64)
+def compiledpattern(pattern, ignorecase=False):
+    """Return the compiled regular expression for pattern.  Patterns are cached across commands"""
+
+    return re.compile(pattern, re.IGNORECASE if ignorecase else 0)
+
+def resolvetlook(tlook):
+    """Return the modification time and full path of the tablelook file tlook
+
+    The file is checked once and then only again if its modification time changes."""
+
+    import os
+    path = os.path.abspath(os.path.expanduser(tlook))
+    try:
+        mtime = os.path.getmtime(path)
+    except EnvironmentError:
+        raise ValueError(_("The tablelook file was not found: %s") % tlook)
+    if TLOOKS.get(tlook, (None,))[0] != mtime:
+        try:
+            with open(path, "rb") as f:
+                if not f.read(1):
+                    raise ValueError(_("The tablelook file is empty: %s") % tlook)
+        except EnvironmentError:
+            raise ValueError(_("The tablelook file could not be read: %s") % tlook)
+        TLOOKS[tlook] = (mtime, path)
+    return TLOOKS[tlook]
+
+def matchingitems(items, subtype, lastprocs, skiplog, start=None, firstmatch=False):
+    """Generate the item numbers and output items to be processed, working back from the end of the Viewer
+
+    items is the output item list of the designated Viewer.
+    subtype is the list of normalized subtypes or ["*"].
+    lastprocs is the number of procedure headings to scan back to or None to scan the whole Viewer.
+    Log items are top level too, but they are not counted as headings.
+    skiplog indicates whether a trailing log item should be skipped
+    start, if not None, is the item number where the scan begins instead of the end
+    If firstmatch is True, the scan stops after the first matching item"""
+
+    itemcount = items.Size()
+    if start is not None:
+        itemcount = start + 1
+    elif skiplog and items.GetItemAt(itemcount-1).GetType() == SpssClient.OutputItemType.LOG:
+        itemcount -= 1
+    headings = 0
+    for itemnumber in range(itemcount-1, -1, -1):
+        item = items.GetItemAt(itemnumber)
+        if lastprocs is not None and item.GetTreeLevel() <= 1:
+            if item.GetType() == SpssClient.OutputItemType.LOG:   # commands echoed between procedures
+                continue
+            headings += 1
+            if headings >= lastprocs:
+                break
+            continue
+        if item.GetType() in [SpssClient.OutputItemType.PIVOT, SpssClient.OutputItemType.NOTE] and\
+           (subtype[0] == "*" or "".join(item.GetSubType().lower().split()) in subtype):
+            yield itemnumber, item
+            if firstmatch:
+                break
 
 
 class PtColumns(object):
@@ -198,7 +655,8 @@ class PtColumns(object):
     def __init__(self, columns, dimension, level, hide,
                  widths, rowlabels, rowlabelwidths, textstyle, textcolor, bgcolor, applyto, customfunction, 
                  printlabels, regexp, tlook,
-                 sigcells, siglevels, hmlocolor, hmhicolor, useabs, hmscale, hmtransparent, hmautocolor):
+                 sigcells, siglevels, hmlocolor, hmhicolor, useabs, hmscale, hmtransparent, hmautocolor,
+                 topn, bottomn, topngroup, hmshared, hmclip, hmbins, hmgroup, ignorecase=False):
         """columns is a sequence of identifiers of columns to act on.
         It can include positive or negative numbers (or things that can be converted to these) and
         strings that will be matched to the lowest level of the column labels ignoring case.
@@ -216,13 +674,41 @@ class PtColumns(object):
         if regexp, nonnumerical text in columns is treated as a regular expression
         sigcells indicates whether to flag significant cells (V24+, CTABLES standard markers only)
         siglevels indicates which levels to flag in case there are two
+        topn and bottomn limit data cell styling to the largest or smallest values
+        topngroup is "all", "rows", or "columns"
+        hmshared indicates that one heatmap scale is used for all the tables
+        hmclip is None or the low and high percentiles for clipping the heatmap range
+        hmbins is the number of bins for the quantile heatmap scale
+        hmgroup is "all", "rows", or "columns" and determines the heatmap scaling groups
+        ignorecase indicates that label text and regular expressions ignore case
         '"""
 
         if columns is None:
             columns = []
         attributesFromDict(locals())  # copy parameters
-        self.encoding = locale.getlocale()[1]
-        self.actionset = any([widths, rowlabelwidths, textstyle, textcolor, bgcolor, customfunction])\
+        self.labelsprinted = 0
+        self.labelswriter = None
+        self.tableid = (None, None, None)   # Viewer item number, subtype, and title of the current table
+        self.suspended = []   # tables with screen updates turned off
+        self.journal = None
+        self.chunksize = None   # number of data rows styled at a time
+        if tlook:
+            self.tlookstamp, self.tlook = resolvetlook(tlook)
+        self.autowidths = bool(widths) and str(widths[0]).lower() == "auto"
+        if self.autowidths:
+            if len(widths) > 1:
+                raise ValueError(_("WIDTHS=AUTO cannot be combined with other widths"))
+            if dimension == 'rows':
+                raise ValueError(_("The rows dimension cannot be combined with resizing"))
+            widths = self.widths = None
+        elif widths:
+            try:
+                widths = self.widths = [int(w) for w in widths]
+            except ValueError:
+                raise ValueError(_("WIDTHS must be AUTO or a list of widths in points"))
+            if min(widths) < 0:
+                raise ValueError(_("Widths cannot be negative"))
+        self.actionset = any([widths, self.autowidths, rowlabelwidths, textstyle, textcolor, bgcolor, customfunction])\
             or hmlocolor or hmhicolor or hmautocolor
         if hide and self.actionset:
             raise ValueError(_("HIDE cannot be combined with other actions"))
@@ -267,7 +753,7 @@ class PtColumns(object):
         if regexplist:   # combine all regexp terms with or if any were found
             try:
                 regexp = "|".join(["("+item+")" for item in regexplist])
-                self.regexp = re.compile(regexp)
+                self.regexp = compiledpattern(regexp, ignorecase)
             except:
                 reerr = sys.exc_info()[1]
                 raise ValueError(_("Invalid regular expression: %s error: %s") % (regexp, str(reerr)))
@@ -305,6 +791,22 @@ class PtColumns(object):
             for f in self.customfunction:
                 self.stylecalls.append(resolvestr(f))
         self.previousUsedValue = ""
+        if (topn or bottomn) and not self.stylecalls:
+            raise ValueError(_("TOPN and BOTTOMN require a style or custom function to apply"))
+        if (topn or bottomn) and self.applyto == "labels":
+            raise ValueError(_("TOPN and BOTTOMN cannot be used with APPLYTO=LABELS"))
+        if hmclip:
+            if len(hmclip) != 2 or not 0 <= hmclip[0] < hmclip[1] <= 100:
+                raise ValueError(_("HMCLIP must be two percentiles in increasing order between 0 and 100"))
+        if hmshared:
+            if not (hmlocolor or hmhicolor or hmautocolor):
+                raise ValueError(_("HMSHARED requires a heatmap specification"))
+            if hmgroup != "all":
+                raise ValueError(_("HMSHARED cannot be combined with HMGROUP=ROWS or COLUMNS"))
+            # rank scales and clipping need the distribution, not just the range
+            self.hmshared = HeatmapRange(keepsample=hmscale in ["rank", "quantile"] or bool(hmclip))
+        else:
+            self.hmshared = None
         
         # significance controls
         self.sigsetup(self.sigcells)
@@ -374,23 +876,258 @@ class PtColumns(object):
             else:
                 return False  # this marker not selected
 
-    def applyaction(self, pt, info):
+    def applyaction(self, pt, info, others=()):
         """Apply specified action to columns or rows of a pivot table.
 
-        pt is the pivot table to process, on which GetSpecificType() is assumed to have been called."""
+        pt is the pivot table to process, on which GetSpecificType() is assumed to have been called.
+        others is a sequence of PtColumns objects for the other dimension to apply to the same table.
+        They share the arrays fetched here."""
 
         #if self.action == 'show' and self.columns[0] == '<<ALL>>':
         #    pt.ShowAll()
         #    return
 
         self.pt = pt   # we will need this available for significance processing
-        if self.tlook:
+        # screen updates stay off until the whole command is done.  See restorescreen
+        pt.SetUpdateScreen(False)
+        self.suspended.append(pt)
+        tableid = self.tableid
+        look = self.tlook and (self.tlook, self.tlookstamp)
+        if look and session.looks.get(tableid) != look:
             pt.SetTableLook(self.tlook)
+        # a table is known to carry the look only if nothing else has changed it since
+        if look and tableid[0] is not None and not (self.actionset or self.hide or others):
+            session.looks[tableid] = look
+        else:
+            session.looks.pop(tableid, None)
         if self.widths and self.columns and self.columns[0] == '<<ALL>>':
             try:
                 pt.SetDataCellWidths(self.widths[0])
             except:
                 pass
+        self.getarrays(pt)
+        if self.journal is not None:
+            self.journalarrays()
+        for other in others:
+            other.sharearrays(self)
+        self.applyselection(info)
+        for other in others:
+            other.applyselection(info)
+        self.flushdeferred()
+        if self.journal is not None and self.journal.baseline:
+            self.applydiff()
+
+    def applydiff(self):
+        """Write the changes recorded for the current table that differ from the baseline journal
+
+        Properties in the baseline that were not changed this time are restored.  The journal
+        keeps the baseline prior values so that a revert goes back to the original table."""
+
+        log = self.journal.table(self.tableid)
+        old = self.journal.baseline.tables.pop(self.tableid, {})
+        arrays = {"datacells": self.datacells.item, "rowlabels": self.rowlabelarray.item,
+            "columnlabels": self.columnlabelarray.item}
+        # deferred hides are recorded where hider tried first.  The baseline has the
+        # location that worked, which may be the fallback
+        for key in [key for key in log if key[1] == "HideLabelsWithDataAt" and key not in old]:
+            fallback = hidefallback(key)
+            if fallback in old:
+                log[fallback] = log.pop(key)
+        moved = {}   # hides that worked only at the fallback location
+        shown = set()   # parts with hidden labels shown again
+        for key, (prior, applied) in old.items():
+            if key not in log:
+                part, name, i, j = key
+                revertentry(arrays[part], name, i, j, prior)
+                if name == "HideLabelsWithDataAt":
+                    shown.add(part)
+        for key, entry in log.items():
+            part, name, i, j = key
+            array = arrays[part]
+            try:
+                if name == "GetValueAt":
+                    pass
+                elif name == "HideLabelsWithDataAt":
+                    if key not in old or part in shown:
+                        try:
+                            array.HideLabelsWithDataAt(i, j)
+                        except:
+                            fallback = hidefallback(key)
+                            array.HideLabelsWithDataAt(*fallback[2:])
+                            moved[key] = fallback
+                elif entry[0] != entry[1]:   # the recorded prior is the current value
+                    if name == "ReSizeColumn":
+                        array.ReSizeColumn(i, entry[1])
+                    else:
+                        getattr(array, name)(i, j, entry[1])
+            except:
+                pass
+            if key in old:
+                entry[0] = old[key][0]
+        for key, fallback in moved.items():
+            log[fallback] = log.pop(key)
+
+    def fitwidths(self, cols, last):
+        """Set the width of each column in cols to fit its contents
+
+        cols is a list of data column numbers.
+        last is the index of the innermost column label row.
+        Widths are computed from the formatted data values and the longest word in the
+        innermost label, so that labels can wrap but values do not, and then set in one pass."""
+
+        import math
+        widths = []
+        for col in cols:
+            size = self.datacells.GetTextSizeAt(0, col) if self.numdatarows else 9
+            bold = self.numdatarows > 0 and self.datacells.GetTextStyleAt(0, col) in \
+                [SpssClient.SpssTextStyleTypes.SpssTSBold, SpssClient.SpssTextStyleTypes.SpssTSBoldItalic]
+            width = max([textwidth(self.datacells.GetValueAt(i, col), size, bold)
+                for i in range(self.numdatarows)] or [0])
+            label = self.columnlabelarray.GetValueAt(last, col)
+            bold = self.columnlabelarray.GetTextStyleAt(last, col) in \
+                [SpssClient.SpssTextStyleTypes.SpssTSBold, SpssClient.SpssTextStyleTypes.SpssTSBoldItalic]
+            size = self.columnlabelarray.GetTextSizeAt(last, col)
+            width = max([width] + [textwidth(word, size, bold) for word in label.split()])
+            widths.append(int(math.ceil(width)) + 2 * CELLMARGIN)
+        for col, width in zip(cols, widths):
+            self.datacells.ReSizeColumn(col, width)
+
+    def restorescreen(self):
+        """Turn screen updates back on for all the tables processed by the command"""
+
+        for pt in self.suspended:
+            try:
+                pt.SetUpdateScreen(True)
+            except:
+                pass   # keep going so that the other tables are restored
+        self.suspended = []
+
+    def applyselection(self, info):
+        """Apply the action to the selected columns or rows of the current table
+
+        The arrays must have been set up by getarrays or sharearrays."""
+
+        if self.hmlocolor or self.hmhicolor or self.hmautocolor:
+            self.hm = Heatmap(self.hmlocolor, self.hmhicolor, self.datacells, self.useabs, self.hmscale,
+            self.hmtransparent, self.hmautocolor, self.pt, self.hmshared, self.hmclip, self.hmbins,
+            self.hmgroup)
+        else:
+            self.hm = None
+        if self.topn or self.bottomn:
+            self.extremes = Extremes(self.topn, self.bottomn, self.topngroup)
+        else:
+            self.extremes = None
+        rowsorcols, last, swapper = self.setlabels()
+        if self.dimension == 'columns':
+            self.printtablelabels(last+1, rowsorcols, "Columns", info)
+        else:
+            self.printtablelabels(rowsorcols, last+1, "Rows", info)
+
+        specificrowsorcols = self.resolvecols(self.columns, rowsorcols, info)
+        scset = set(specificrowsorcols)
+        if self.widths:
+            wdict = dict(list(zip(specificrowsorcols, self.widths)))   # won't work with regexp
+
+        autocols = []
+        chunked = []   # rows or columns to style in blocks of rows
+        # process table data and label cells for width, hiding, and formatting
+        for roworcol, i, j, wkey in self.selection(rowsorcols, last, swapper, scset):
+            if self.hide:
+                ###self.labels.HideLabelsWithDataAt(i,j)
+                self.hider(self.dimension, last, i, j)
+            else:
+                if self.widths and not "<<ALL>>" in scset:   #all case is already processed
+                    self.datacells.ReSizeColumn(roworcol, wdict[wkey])
+                if self.autowidths:
+                    autocols.append(roworcol)
+                if self.chunksize and (self.actionset or self.hm):
+                    chunked.append(roworcol)
+                elif self.actionset or self.hm:
+                    rc = self.dostyles(roworcol)
+                    if rc is False:
+                        break
+            #else:
+            #    self.labels.ShowAllLabelsAndDataInDimensionAt(i,j)
+        if chunked:
+            self.chunkstyles(chunked)
+        if autocols:
+            self.fitwidths(autocols, last)
+        if self.rowlabels:
+            labels = self.rowlabelarray
+            rowsorcols = labels.GetNumColumns()
+            wdict = dict(list(zip(self.resolvecols(self.rowlabels, rowsorcols, info), self.rowlabelwidths)))
+            # process table data and label cells for width, hiding, and formatting
+            for  roworcol in range(rowsorcols):
+                newwidth = wdict.get(roworcol, None)
+                if not newwidth is None:
+                    labels.SetRowLabelWidthAt(0,roworcol, newwidth)   #9/6/2022
+        if self.extremes:
+            self.extremestyles()
+        if self.hm:
+            self.hm.setcolor()
+
+    def chunkstyles(self, selected):
+        """Apply styles to the selected rows or columns in blocks of chunksize data rows
+
+        selected is the list of row or column numbers.
+        The deferred actions and the heatmap colors are written after each block, so the
+        buffered values and targets are limited to one block.  The heatmap ranges are
+        accumulated for the whole selection first by a pass that does not keep the values."""
+
+        coldim = self.dimension == "columns"
+        if self.hm and self.hm.shared is None and self.applyto != "labels":
+            hm = self.hm
+            self.hm = HeatmapRanges(self.hmgroup, self.hmscale in ["rank", "quantile"] or bool(self.hmclip))
+            expression = self.applyto not in ["both", "datacells"]
+            for roworcol in selected:
+                self.datacellstyles(roworcol, expression, scanonly=True)
+            hm.shared, self.hm = self.hm, hm
+        if not coldim:
+            import bisect
+            selected = sorted(selected)
+        for start in range(0, max(self.numdatarows, 1), self.chunksize):
+            stop = min(start + self.chunksize, self.numdatarows)
+            rc = None
+            if coldim:
+                block = selected
+            else:   # the selected rows in this block
+                block = selected[bisect.bisect_left(selected, start):bisect.bisect_left(selected, stop)]
+            for roworcol in block:
+                if coldim:
+                    rc = self.dostyles(roworcol, (start, stop), labels=start == 0)
+                else:
+                    rc = self.dostyles(roworcol)
+                if rc is False:
+                    break
+            if self.hm:
+                self.hm.setcolor()
+                self.hm.clear()
+            self.flushdeferred()
+            if rc is False:
+                break
+
+    def scanaction(self, pt):
+        """Record the selected heatmap values of a pivot table without modifying it.
+
+        This is the first pass when the heatmap scale is shared across tables.
+        The values go straight into the shared range accumulator, so nothing
+        is retained for the table."""
+
+        if self.applyto == "labels":
+            return
+        self.pt = pt
+        self.getarrays(pt)
+        self.hm = self.hmshared
+        self.extremes = None
+        rowsorcols, last, swapper = self.setlabels()
+        scset = set(self.resolvecols(self.columns, rowsorcols, None))
+        expression = self.applyto not in ["both", "datacells"]
+        for roworcol, i, j, wkey in self.selection(rowsorcols, last, swapper, scset):
+            self.datacellstyles(roworcol, expression, scanonly=True)
+
+    def getarrays(self, pt):
+        """Set up the cell and label arrays and table structure for pt"""
+
         self.datacells = pt.DataCellArray()
         self.rowlabelarray = fRowLabelArray(pt)
         self.columnlabelarray = fColumnLabelArray(pt)
@@ -398,80 +1135,134 @@ class PtColumns(object):
 
         self.numdatarows = self.datacells.GetNumRows()
         self.numdatacols = self.datacells.GetNumColumns()
-        if self.hmlocolor or self.hmhicolor or self.hmautocolor:
-            self.hm = Heatmap(self.hmlocolor, self.hmhicolor, self.datacells, self.useabs, self.hmscale,
-            self.hmtransparent, self.hmautocolor, self.pt)
-        else:
-            self.hm = None
+        self.rowsummaries = {}
+        self.hiddenrows = set()
+        self.pending = {}
+
+    def journalarrays(self):
+        """Replace the arrays of the current table with versions that record changes in the journal"""
+
+        log = self.journal.table(self.tableid)
+        baseline = None
+        if self.journal.baseline is not None:
+            baseline = self.journal.baseline.tables.get(self.tableid, {})
+        labels = self.columnlabelarray
+        lastrow = labels.GetNumRows() - 1
+        self.datacells = JournalArray(self.datacells, "datacells", log,
+            lambda col: labels.GetColumnLabelWidthAt(lastrow, col), baseline)
+        self.rowlabelarray = JournalArray(self.rowlabelarray, "rowlabels", log, baseline=baseline)
+        self.columnlabelarray = JournalArray(labels, "columnlabels", log, baseline=baseline)
+
+    def sharearrays(self, source):
+        """Use the table, arrays, and table structure already set up by the PtColumns object source"""
+
+        for name in ["pt", "thetable", "tableid", "datacells", "rowlabelarray", "columnlabelarray",
+            "coltablemap", "numdatarows", "numdatacols", "rowsummaries", "hiddenrows", "pending"]:
+            setattr(self, name, getattr(source, name))
+
+    def deferred(self, key, flush, factory=list):
+        """Return the accumulator for key in the current table, creating it with factory on first use
+
+        flush(accumulator, more) is called once after all the cells of the table have been styled,
+        in the order in which the keys were first used.  This lets custom functions collect
+        their cells and make the changes together."""
+
+        if key not in self.pending:
+            self.pending[key] = (factory(), flush)
+        return self.pending[key][0]
+
+    def flushdeferred(self):
+        """Call the deferred actions for the current table
+
+        The pending dictionary is shared with the other selections on the table, so it is
+        emptied in place."""
+
+        pending = dict(self.pending)
+        self.pending.clear()
+        for accumulator, flush in pending.values():
+            flush(accumulator, self)
+
+    def rowsummary(self, start=0, stop=None):
+        """Return the RowSummary of the data columns start through stop-1 of the current table
+
+        The summary is built once per table and column range, so custom functions
+        called for every cell can share it."""
+
+        if stop is None:
+            stop = self.numdatacols
+        key = (start, stop)
+        if key not in self.rowsummaries:
+            self.rowsummaries[key] = RowSummary(self.datacells, self.numdatarows, start, stop)
+        return self.rowsummaries[key]
+
+    def setlabels(self):
+        """Set self.labels to the label array of the selection dimension.
+
+        Return the number of rows or columns, the index of the innermost label level,
+        and a function mapping a level and row or column number to label coordinates"""
+
         if self.dimension == 'columns':
             self.labels = self.columnlabelarray
             rowsorcols = self.labels.GetNumColumns()
             last = max(self.labels.GetNumRows() - 1, 0)
-            self.printtablelabels(last+1, rowsorcols, "Columns", info)
             def swapper(i, j):
                 return ((i + self.level + 1) % (last+1), j)
         else:
             self.labels = self.rowlabelarray
             rowsorcols = self.labels.GetNumRows()
             last = max(self.labels.GetNumColumns() -1, 0)
-            self.printtablelabels(rowsorcols, last+1, "Rows", info)
             def swapper(i, j):
                 return (j, (i + self.level + 1) % (last+1))
+        return rowsorcols, last, swapper
 
-        specificrowsorcols = self.resolvecols(self.columns, rowsorcols, info)
-        scset = set(specificrowsorcols)
-        if self.widths:
-            wdict = dict(list(zip(specificrowsorcols, self.widths)))   # won't work with regexp
+    def selection(self, rowsorcols, last, swapper, scset):
+        """Generate (roworcol, i, j, wkey) for each selected row or column
 
-        try:
-            pt.SetUpdateScreen(False)
-            # process table data and label cells for width, hiding, and formatting
-            for  roworcol in range(rowsorcols):
-                i,j = swapper(last, roworcol)
-                wkey = None
-                # first see if row or column number was specified or taking all
-                if roworcol in scset or "<<ALL>>" in scset:
-                    wkey = roworcol
-                else:
-                    # otherwise see if text was specified or any regular expression matches
-                    v = self.labels.GetValueAt(i,j)
-                    if self.regexp:
-                        if self.regexp.search(v):
-                            wkey = v
-                    else:
-                        if v in scset:
-                            wkey = v
-                if not wkey is None:
-                    if self.hide:
-                        ###self.labels.HideLabelsWithDataAt(i,j)
-                        self.hider(self.dimension, last, i, j)
-                    else:
-                        if self.widths and not "<<ALL>>" in scset:   #all case is already processed
-                            self.datacells.ReSizeColumn(roworcol, wdict[wkey])
-                        if self.actionset or self.hm:
-                            rc = self.dostyles(roworcol)
-                            if rc is False:
-                                break
-                    #else:
-                    #    self.labels.ShowAllLabelsAndDataInDimensionAt(i,j)
-            if self.rowlabels:
-                labels = self.rowlabelarray
-                rowsorcols = labels.GetNumColumns()
-                wdict = dict(list(zip(self.resolvecols(self.rowlabels, rowsorcols, info), self.rowlabelwidths)))
-                # process table data and label cells for width, hiding, and formatting
-                for  roworcol in range(rowsorcols):
-                    newwidth = wdict.get(roworcol, None)
-                    if not newwidth is None:
-                        labels.SetRowLabelWidthAt(0,roworcol, newwidth)   #9/6/2022
-            if self.hm:
-                self.hm.setcolor()
-        finally:
-            pt.SetUpdateScreen(True)
+        i and j are the label coordinates at the selection level.
+        wkey is the number or label text that matched
+        Labels are only read if text or a regular expression was specified"""
+
+        # first see if row or column number was specified or taking all
+        if "<<ALL>>" in scset:
+            matched = dict((roworcol, roworcol) for roworcol in range(rowsorcols))
+        else:
+            matched = dict((item, item) for item in scset if isinstance(item, int))
+        texts = [item for item in scset if isinstance(item, str) and item != "<<ALL>>"]
+        if len(matched) < rowsorcols and (self.regexp or texts):
+            # otherwise see if text was specified or any regular expression matches.
+            # Each distinct label is tested only once
+            index = self.labelindex(rowsorcols, last, swapper)
+            if self.regexp:
+                for v, positions in index.items():
+                    if self.regexp.search(v):
+                        for roworcol in positions:
+                            matched.setdefault(roworcol, v)
+            else:
+                for item in texts:
+                    for roworcol in index.get(self.ignorecase and item.casefold() or item, []):
+                        matched.setdefault(roworcol, item)
+        for roworcol in sorted(matched):
+            i,j = swapper(last, roworcol)
+            yield roworcol, i, j, matched[roworcol]
+
+    def labelindex(self, rowsorcols, last, swapper):
+        """Return a dictionary mapping the label text at the selection level to row or column numbers
+
+        Text is case folded if ignorecase is in effect and regular expressions are not used"""
+
+        fold = self.ignorecase and not self.regexp
+        index = {}
+        for roworcol in range(rowsorcols):
+            v = self.labels.GetValueAt(*swapper(last, roworcol))
+            if fold:
+                v = v.casefold()
+            index.setdefault(v, []).append(roworcol)
+        return index
 
     def buildcolstruc(self, pt):
         """Analyze column subtable structure and return map or None"""
         
-        if not v24ok:
+        if not v24ok():
             return None
         if pt.GetSigMarkersType() != SpssClient.SpssSigMarkerTypes.SpssSigSimple:
             return None
@@ -547,23 +1338,25 @@ class PtColumns(object):
             #except:
                 #pass    
                 
-    def dostyles(self, roworcol):
+    def dostyles(self, roworcol, rows=None, labels=True):
         """Apply any requested styles to labels and/or datacells.
 
         self.labels is the relevant dimension labels.
         self.datacells is the table data cell array
-        roworcol is the current table row or column number"""
+        roworcol is the current table row or column number
+        rows is an optional (start, stop) range of the data rows of a column to style.
+        labels is False if the label styles have already been applied"""
 
         # the datacells and labels objects are exposed as globals in case customfunctions need
         # the one not being passed in the style call
 
         if self.applyto != "labels":  #datacell styles
             expression = self.applyto not in ["both", "datacells"]
-            rc = self.datacellstyles(roworcol, expression)
+            rc = self.datacellstyles(roworcol, expression, rows=rows)
             if rc is False:
                 return False
 
-        if self.applyto in ["both", "labels"]:   # label styles
+        if labels and self.applyto in ["both", "labels"]:   # label styles
             rc = self.labelcellstyles(roworcol, self.labels.GetNumRows(), self.labels.GetNumColumns())
             if rc is False:
                 return False
@@ -572,7 +1365,8 @@ class PtColumns(object):
         """Return a list of column or row specifications for indexes with negative values resolved.
 
         rowsorcols is the actual number of data columns or rows in the current pivot table.
-	If an out-of-bounds column number is found, it is removed from the list with a warning."""
+	If an out-of-bounds column number is found, it is removed from the list with a warning.
+	No warning is issued if info is None."""
 
         ret = []
         for item in colarray:
@@ -581,10 +1375,12 @@ class PtColumns(object):
                 if item < 0:
                     item += rowsorcols
                 if not (0 <= item < rowsorcols):
+                    if info is None:
+                        continue
                     info.addrow(_("""A specified row or column label number does not exist in a selected table.
 It will be ignored.  Any column-specific width settings may be incorrect.
 Label number: %s.  Table size: %s""")\
-                           % (item, rowsorcols))
+                           % (item, rowsorcols), count=True)
                     continue
             except ValueError:
                 pass
@@ -595,45 +1391,54 @@ Label number: %s.  Table size: %s""")\
         """Print row or column labels of table
 
 	rows and cols are the dimensions.
-	which is "rows" or "columns"."""
-        if self.printlabels:
+	which is "rows" or "columns".
+	Listing stops after MAXPRINTLABELS labels in the command unless written to a labels file."""
+        if self.labelswriter:
+            self.labelswriter.write(self.tableid[0], self.tableid[1], which, 
+                [[self.labels.GetValueAt(i, j) for j in range(cols)] for i in range(rows)])
+            return
+        if self.printlabels and self.labelsprinted < MAXPRINTLABELS:
             info.addrow(_("Table Labels: %s.  Dimensions: %s, %s") % (which, rows, cols))
             for i in range(rows):
                 for j in range(cols):
+                    if self.labelsprinted >= MAXPRINTLABELS:
+                        info.addrow(_("Label listing stopped after %d labels") % MAXPRINTLABELS)
+                        return
                     info.addrow("%d %d: %s" % (i, j, self.labels.GetValueAt(i, j)))
+                    self.labelsprinted += 1
                     ###print i, j, self.labels.GetValueAt(i, j)
 
-    def datacellstyles(self, roworcol, expression):
+    def datacellstyles(self, roworcol, expression, scanonly=False, rows=None):
         """Apply datacell styles looping over rows or columns
 
 	roworcol is the row or column number to process.
-	expression is True if an applyto expression exists."""
+	expression is True if an applyto expression exists.
+	If scanonly is True, heatmap values are recorded but no styles are applied.
+	rows is an optional (start, stop) range of the data rows to process in a column."""
 
         coldim = self.dimension == "columns"
         if coldim:
-            limit = self.numdatarows
+            start, limit = rows or (0, self.numdatarows)
         else:
-            limit = self.numdatacols
+            start, limit = 0, self.numdatacols
 
-        for i in range(limit):
+        if expression:
+            xvalues = self.expressionvalues(roworcol, coldim, start, limit)
+        for i in range(start, limit):
             outcome = True
             if coldim:
                 row, col = i, roworcol
             else:
                 row,col = roworcol, i
             if expression:
-                try:   # this api is new in V18 or 17.0.2
-                    x = float(self.datacells.GetUnformattedValueAt(row, col))
-                except AttributeError:
-                    x = floatex(self.datacells.GetValueAt(row, col), self.datacells.GetNumericFormatAt(row, col))
-                except ValueError:
-                    x = self.datacells.GetValueAt(row, col)   # 2/19/2015
+                x = xvalues[i - start]
                 try:
                     if outcome:
                         outcome = eval(self.applyto, {'x':x, "i":i, "ii": roworcol})
                 except (NameError, SyntaxError) as e:
                     if not isinstance(self.applyto, str):
-                        self.applyto = str(self.applyto, self.encoding)
+                        import locale
+                        self.applyto = str(self.applyto, locale.getlocale()[1])
                     raise ValueError(_("APPLYTO expression is invalid: %s") % self.applyto)
                 except:
                     outcome = False
@@ -645,13 +1450,49 @@ Label number: %s.  Table size: %s""")\
                 # Thus sig formatting can suppress formatting that would otherwise be applied
                 if self.hm:
                     self.hm.recordcellinfo(row, col, self.datacells.GetUnformattedValueAt(row, col), self.useabs)  # a string
+                if scanonly:
+                    continue
                 if self.checksigcells(row, col): 
+                    if self.extremes:   # styles are deferred until the values have been ranked
+                        self.extremes.recordcellinfo(row, col, self.datacells.GetUnformattedValueAt(row, col))
+                        continue
                     for f in self.stylecalls:
                         rc = f(self.datacells, row, col, self.numdatarows, self.numdatacols, "datacells",  self)
                         if rc is False:
                             return rc
 
 
+    def expressionvalues(self, roworcol, coldim, start, limit):
+        """Return the values of the data cells start to limit - 1 in row or column roworcol for
+        an APPLYTO expression
+
+        Numbers are returned as floats and other values as their text."""
+
+        if coldim:
+            cells = [(i, roworcol) for i in range(start, limit)]
+        else:
+            cells = [(roworcol, i) for i in range(start, limit)]
+        try:   # this api is new in V18 or 17.0.2
+            values = [self.datacells.GetUnformattedValueAt(row, col) for row, col in cells]
+        except AttributeError:
+            return decodevalues([self.datacells.GetValueAt(row, col) for row, col in cells],
+                [self.datacells.GetNumericFormatAt(row, col) for row, col in cells])
+        for k, (row, col) in enumerate(cells):
+            try:
+                values[k] = float(values[k])
+            except ValueError:
+                values[k] = self.datacells.GetValueAt(row, col)   # 2/19/2015
+        return values
+
+    def extremestyles(self):
+        """Apply data cell styles to the cells chosen by TOPN and BOTTOMN"""
+
+        for row, col in self.extremes.selected():
+            for f in self.stylecalls:
+                rc = f(self.datacells, row, col, self.numdatarows, self.numdatacols, "datacells",  self)
+                if rc is False:
+                    return rc
+
     def labelcellstyles(self, roworcol, numlabelrows, numlabelcols):
         """Apply label styles
 
@@ -680,7 +1521,8 @@ Label number: %s.  Table size: %s""")\
                 pass
             
 class Heatmap():
-    def __init__(self, locolor, hicolor, datacells, useabs, hmscale, hmtransparent, hmautocolor, pt):
+    def __init__(self, locolor, hicolor, datacells, useabs, hmscale, hmtransparent, hmautocolor, pt, shared=None,
+        hmclip=None, hmbins=5, hmgroup="all"):
         if locolor is None and hicolor is None and not hmautocolor:
             self.hm = False
             return
@@ -698,38 +1540,117 @@ class Heatmap():
         self.rgbrange = [item[1] - item[0] for item in zip(locolor, hicolor)]
         #self.datalow = None
         #self.datahi = None
-        self.targets = []
-        self.datamin = sys.float_info.max
-        self.datamax = -sys.float_info.max        
+        # targets are kept in parallel typed arrays rather than as an object per cell
+        self.rows = array('i')
+        self.cols = array('i')
+        self.values = array('d')
+        self.ranges = {}   # group key: [min, max], maintained as values are recorded
+
+    def clear(self):
+        """Discard the recorded cells after their colors have been set"""
+
+        self.rows = array('i')
+        self.cols = array('i')
+        self.values = array('d')
+        self.ranges = {}
+
+    def sharedrange(self, group):
+        """Return the accumulated range for group or None if there is none
+
+        shared is a HeatmapRange for all the cells or a HeatmapRanges by group.
+        The range of a group is either a HeatmapRange or a [min, max] pair"""
+
+        if isinstance(self.shared, HeatmapRanges):
+            return self.shared.ranges[group]
+        return self.shared
 
     def recordcellinfo(self, row, col, value, useabs):
-        """Make a list of selected cell coordinates and values
+        """Record selected cell coordinates and values and update the range
         
         useabs indicates whether to use absolute values or not"""
         
         try:
             value = float(value)
-            if useabs:
-                value = abs(value)
-            self.targets.append(cellinfo(row, col, value))
         except:   # ignore invalid values
-            pass
+            return
+        if useabs:
+            value = abs(value)
+        self.rows.append(row)
+        self.cols.append(col)
+        self.values.append(value)
+        if self.hmgroup == "all":
+            key = None
+        else:
+            key = row if self.hmgroup == "rows" else col
+        r = self.ranges.get(key)
+        if r is None:
+            self.ranges[key] = [value, value]
+        elif value < r[0]:
+            r[0] = value
+        elif value > r[1]:
+            r[1] = value
         
-    def setdatarange(self):
-        """Find and save the min and max values for the selected data in the table"""
+    def setdatarange(self, values, group=None):
+        """Find and save the min and max of values, the selected data in the table or
+        in one row or column group
         
-
-        # find selected cell values min and max
-        # ignore any cells where this can't be computed
-        for v in self.targets:
-            try:                
-                self.datamin = min(v.value, self.datamin)
-                self.datamax = max(v.value, self.datamax)
-            except:
-                pass
+        group is the group key or None for the whole table.
+        The min and max were tracked as the values were recorded, so the values
+        are only read if clipping was requested.
+        If a shared range has been accumulated, it is used instead.
+        If clipping was requested, the limits are the clip percentiles of the values"""
+        
+        shared = self.sharedrange(group)
+        if isinstance(shared, list):   # a [min, max] pair from HeatmapRanges
+            self.datamin, self.datamax = shared
+        elif shared is not None:
+            self.datamin = shared.datamin
+            self.datamax = shared.datamax
+            if self.hmclip:
+                sortedvalues = shared.sortedsample()
+        else:
+            self.datamin, self.datamax = self.ranges[group]
+            if self.hmclip:
+                sortedvalues = sorted(values)
+        if self.hmclip and sortedvalues:
+            self.datamin = percentile(sortedvalues, self.hmclip[0])
+            self.datamax = percentile(sortedvalues, self.hmclip[1])
         
         self.datarange = max(self.datamax - self.datamin, 1e-100)
 
+    def groups(self):
+        """Return a list of (group key, target positions) for each scaling group"""
+
+        if self.hmgroup == "all":
+            return [(None, range(len(self.values)))] if self.values else []
+        keys = self.rows if self.hmgroup == "rows" else self.cols
+        groups = {}
+        for k, key in enumerate(keys):
+            if key not in groups:
+                groups[key] = array('i')
+            groups[key].append(k)
+        return list(groups.items())
+
+    def scalefractions(self, values, group=None):
+        """Return the position of each value on the color scale as a fraction from 0 to 1
+
+        For the rank and quantile scales, this is the scaled rank of the value, which
+        one sort of the values provides.  Otherwise it is the position in the data range
+        with values outside any clipping limits pulled in to the limits."""
+
+        if self.hmscale in ["rank", "quantile"]:
+            if self.shared is not None:
+                fractions = self.sharedrange(group).rankfractions(values)
+            else:
+                fractions = rankfractions(values)
+            if self.hmscale == "quantile":
+                bins = self.hmbins
+                fractions = [min(int(f * bins), bins - 1) / (bins - 1.) for f in fractions]
+            return fractions
+        self.setdatarange(values, group)
+        lo, hi = self.datamin, self.datamax
+        return [(min(max(v, lo), hi) - lo) / self.datarange for v in values]
+
         
     def setcolor(self):
         """set background color for value based on proportion of value in data range
@@ -737,9 +1658,17 @@ class Heatmap():
         row, col is cell location
         absolute values have been accounted for already"""
         
-        self.setdatarange()  
-        for cell in self.targets:
-            incr = (cell.value - self.datamin) / self.datarange  # forced positive
+        import math
+        # scale each group separately but set all the colors in one pass
+        if self.hmgroup == "all":
+            fractions = self.scalefractions(self.values) if self.values else []
+        else:
+            fractions = array('d', [0.]) * len(self.values)
+            for key, positions in self.groups():
+                groupfractions = self.scalefractions([self.values[k] for k in positions], key)
+                for k, incr in zip(positions, groupfractions):
+                    fractions[k] = incr
+        for row, col, incr in zip(self.rows, self.cols, fractions):   # incr is between 0 and 1
             if self.hmscale == "qblend":
                 rgb = [math.sqrt(self.locolor[i]**2 * (1. - incr) + self.hicolor[i]**2 * incr) for i in range(3)]
             else:
@@ -748,11 +1677,336 @@ class Heatmap():
                 elif self.hmscale == "square":
                     incr = incr ** 2
                 rgb = [self.locolor[i] + incr * self.rgbrange[i] for i in range(3)]
-            self.datacells.SetBackgroundColorAt(cell.row, cell.col, RGB(rgb))   # RGB converts to ints
+            self.datacells.SetBackgroundColorAt(row, col, RGB(rgb))   # RGB converts to ints
             if self.hmtransparent:
-                self.datacells.SetTextColorAt(cell.row, cell.col, RGB(rgb))            
+                self.datacells.SetTextColorAt(row, col, RGB(rgb))            
+
+        
+class HeatmapRange():
+    """Accumulate the range of the selected heatmap values across tables"""
+
+    def __init__(self, keepsample=False, samplesize=100000, rng=None):
+        """keepsample indicates that a sample of the values is needed for ranks or clipping.
+        It is a uniform reservoir sample of at most samplesize values, so memory
+        stays bounded however many tables are scanned.
+        rng is an optional random generator shared with other ranges"""
 
+        self.datamin = sys.float_info.max
+        self.datamax = -sys.float_info.max
+        self.keepsample = keepsample
+        self.samplesize = samplesize
+        self.sample = []
+        self.count = 0
+        self.sorted = None
+        self.random = rng
+        if keepsample and rng is None:
+            import random
+            self.random = random.Random(0)   # repeatable results
+
+    def recordcellinfo(self, row, col, value, useabs):
+        """Fold a cell value into the running min and max
         
+        The signature matches Heatmap.recordcellinfo.  Invalid values are ignored"""
+
+        try:
+            value = float(value)
+        except:
+            return
+        if useabs:
+            value = abs(value)
+        if value < self.datamin:
+            self.datamin = value
+        if value > self.datamax:
+            self.datamax = value
+        if self.keepsample:
+            self.count += 1
+            if len(self.sample) < self.samplesize:
+                self.sample.append(value)
+            else:
+                k = self.random.randrange(self.count)
+                if k < self.samplesize:
+                    self.sample[k] = value
+
+    def sortedsample(self):
+        """Return the sorted value sample"""
+
+        if self.sorted is None:
+            self.sorted = sorted(self.sample)
+        return self.sorted
+
+    def rankfractions(self, values):
+        """Return the estimated rank fraction of each value within all the scanned values"""
+
+        import bisect
+        sample = self.sortedsample()
+        scale = max(len(sample) - 1, 1)
+        return [min(max((bisect.bisect_left(sample, v) + bisect.bisect_right(sample, v) - 1) / 2. / scale, 0.), 1.)
+            for v in values]
+
+class HeatmapRanges():
+    """Heatmap ranges by group key, for a pass over one large table
+
+    A range is a [min, max] pair unless a sample is needed, when it is a HeatmapRange.
+    The samples share one random generator, so there may be a group per row."""
+
+    def __init__(self, hmgroup, keepsample=False):
+        self.hmgroup = hmgroup
+        self.keepsample = keepsample
+        self.ranges = {}
+        if keepsample:
+            import random
+            self.random = random.Random(0)   # repeatable results
+
+    def recordcellinfo(self, row, col, value, useabs):
+        """Fold a cell value into the range of its group
+
+        The signature matches Heatmap.recordcellinfo"""
+
+        if self.hmgroup == "all":
+            key = None
+        else:
+            key = row if self.hmgroup == "rows" else col
+        r = self.ranges.get(key)
+        if self.keepsample:
+            if r is None:
+                r = self.ranges[key] = HeatmapRange(True, rng=self.random)
+            r.recordcellinfo(row, col, value, useabs)
+            return
+        try:
+            value = float(value)
+        except:
+            return
+        if useabs:
+            value = abs(value)
+        if r is None:
+            self.ranges[key] = [value, value]
+        elif value < r[0]:
+            r[0] = value
+        elif value > r[1]:
+            r[1] = value
+
+class RowSummary():
+    """Per-row aggregates of a range of data columns
+
+    The numeric aggregates and the blank flags are each computed in a single
+    pass over the cells the first time they are needed, and later queries
+    are answered from the saved lists."""
+
+    def __init__(self, datacells, numrows, start, stop):
+        attributesFromDict(locals())
+        self.maxes = None
+        self.counts = None
+        self.blanks = None
+
+    def summarize(self):
+        """Compute the maximum and the number of nonmissing numeric values in each row"""
+
+        self.maxes = []
+        self.counts = []
+        for i in range(self.numrows):
+            rowmax = None
+            count = 0
+            for col in range(self.start, self.stop):
+                try:
+                    v = float(self.datacells.GetUnformattedValueAt(i, col))
+                except:
+                    continue
+                if v != v:   # NaN
+                    continue
+                count += 1
+                if rowmax is None or v > rowmax:
+                    rowmax = v
+            self.maxes.append(rowmax)
+            self.counts.append(count)
+
+    def rowmax(self, row):
+        """Return the largest numeric value in row or None if there are none"""
+
+        if self.maxes is None:
+            self.summarize()
+        return self.maxes[row]
+
+    def count(self, row):
+        """Return the number of nonmissing numeric values in row"""
+
+        if self.counts is None:
+            self.summarize()
+        return self.counts[row]
+
+    def isblank(self, row):
+        """Return True if every cell in row displays as blank"""
+
+        if self.blanks is None:
+            self.blanks = [all(self.datacells.GetValueAt(i, col) == "" for col in range(self.start, self.stop))
+                for i in range(self.numrows)]
+        return self.blanks[row]
+
+class LabelsWriter(object):
+    """Write table label grids to a file as they are read
+
+    The file is CSV, one row per label cell, if its name ends with .csv and JSON lines,
+    one object per table, otherwise."""
+
+    def __init__(self, filespec):
+        self.csv = filespec.lower().endswith(".csv")
+        try:
+            self.f = open(filespec, "w", encoding="utf-8", newline="")
+        except EnvironmentError:
+            raise ValueError(_("The labels file could not be opened: %s") % filespec)
+        if self.csv:
+            import csv
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(["table", "subtype", "dimension", "row", "column", "label"])
+
+    def write(self, tableindex, subtype, dimension, labels):
+        """Write the label grid of one table
+
+        tableindex is the Viewer item number of the table.
+        dimension is "Rows" or "Columns".
+        labels is a list of rows of label text."""
+
+        if self.csv:
+            for i, row in enumerate(labels):
+                for j, label in enumerate(row):
+                    self.writer.writerow([tableindex, subtype, dimension, i, j, label])
+        else:
+            import json
+            self.f.write(json.dumps({"table": tableindex, "subtype": subtype,
+                "dimension": dimension, "labels": labels}) + "\n")
+
+    def close(self):
+        self.f.close()
+
+class Extremes():
+    """Select the largest and/or smallest values among the qualifying data cells"""
+
+    def __init__(self, topn, bottomn, group):
+        """topn and bottomn are the number of cells to select at each end or None
+        group is "all", "rows", or "columns"
+        """
+
+        attributesFromDict(locals())
+        self.candidates = {}
+
+    def recordcellinfo(self, row, col, value):
+        """Add a cell to the candidate list for its group
+        
+        Cells whose value cannot be converted to a float are ignored"""
+
+        try:
+            value = float(value)
+        except:
+            return
+        if value != value:   # NaN
+            return
+        if self.group == "rows":
+            key = row
+        elif self.group == "columns":
+            key = col
+        else:
+            key = None
+        self.candidates.setdefault(key, []).append((value, row, col))
+
+    def selected(self):
+        """Return the (row, col) locations of the selected cells in table order
+        
+        A partial selection is used, so the cost is O(n log N) rather than a full sort"""
+
+        import heapq
+        value = lambda cell: cell[0]
+        chosen = set()
+        for cells in self.candidates.values():
+            if self.topn:
+                chosen.update((row, col) for v, row, col in heapq.nlargest(self.topn, cells, key=value))
+            if self.bottomn:
+                chosen.update((row, col) for v, row, col in heapq.nsmallest(self.bottomn, cells, key=value))
+        return sorted(chosen)
+
+@functools.lru_cache(maxsize=256)
+def numericparser(format):
+    """Return a function that converts text displayed with the numeric cell format format to a float
+
+    The format is analyzed once.  Currency and percent signs and spaces are removed, and
+    parentheses indicate a negative value.  If the format has a period before a comma, as in
+    #.###,##, the comma is the decimal symbol.  Grouping symbols are removed only if the
+    format has them and they separate groups of three digits in the integer part.
+    The function raises ValueError if the text is not a number or is ambiguous, such as
+    12,5 with a format without grouping."""
+
+    decimalcomma = bool(format) and "." in format and "," in format and format.index(".") < format.index(",")
+    grouping, decimal = (".", ",") if decimalcomma else (",", ".")
+    grouped = bool(format) and grouping in format
+    strip = re.compile(r"[^0-9eE+\-.,()]")
+    groups = re.compile(r"[+-]?\d{1,3}(?:%s\d{3})*$" % re.escape(grouping))
+
+    def parse(text):
+        if not decimalcomma:
+            try:
+                return float(text)
+            except ValueError:
+                pass
+        text = strip.sub("", text)
+        negative = text.startswith("(") and text.endswith(")")
+        whole, point, fraction = text.strip("()").partition(decimal)
+        if grouping in whole:
+            if not (grouped and groups.match(whole)):
+                raise ValueError(text)
+            whole = whole.replace(grouping, "")
+        value = float(whole + "." + fraction if point else whole)   # rejects symbols in fraction
+        return -value if negative else value
+    return parse
+
+def decodevalue(value, format=None):
+    """Return the float value of text displayed with numeric cell format format
+
+    Values the format parser cannot handle are passed to floatex."""
+
+    try:
+        return numericparser(format)(value)
+    except (ValueError, TypeError):
+        return floatex(value, format)
+
+def decodevalues(values, formats):
+    """Return a list of the float values of the texts in values, or the text if it is not a number
+
+    formats is a parallel list of the numeric cell formats."""
+
+    result = []
+    for value, format in zip(values, formats):
+        try:
+            result.append(decodevalue(value, format))
+        except:
+            result.append(value)
+    return result
+
+def rankfractions(values):
+    """Return the rank of each value scaled to the range 0 to 1
+    
+    Tied values get their average rank."""
+
+    n = len(values)
+    order = sorted(range(n), key=values.__getitem__)
+    fractions = [0.] * n
+    scale = max(n - 1, 1)
+    start = 0
+    while start < n:
+        end = start
+        while end + 1 < n and values[order[end + 1]] == values[order[start]]:
+            end += 1
+        rank = (start + end) / 2. / scale
+        for k in range(start, end + 1):
+            fractions[order[k]] = rank
+        start = end + 1
+    return fractions
+
+def percentile(sortedvalues, pct):
+    """Return the pct percentile of sortedvalues by linear interpolation"""
+
+    pos = (len(sortedvalues) - 1) * pct / 100.
+    lo = int(pos)
+    hi = min(lo + 1, len(sortedvalues) - 1)
+    return sortedvalues[lo] + (sortedvalues[hi] - sortedvalues[lo]) * (pos - lo)
+
 def set23(pt):
     """Set pt incompatible if V23 or later
     
@@ -806,19 +2060,27 @@ def resolvestr(afunc):
         bf = f.split(".")
         if len(bf) != 2:
             raise ValueError(_("function reference %s not valid") % f)
-        if bf[0] == "__main__":
-            customfunction = eval("""sys.modules["__main__"].%s""" % bf[1])
+        # functions from __main__ can be redefined between commands, so they are not cached
+        if bf[0] != "__main__" and f in RESOLVED:
+            customfunction, nargs = RESOLVED[f]
         else:
-            exec("from %s import %s" % (bf[0], bf[1]))
-            customfunction = locals()[bf[1]]
-        argspec = inspect.getfullargspec(customfunction)[0]
-        nargs = len(argspec)
-        if nargs < 7 or nargs > 8:
-            argspecj = ", ".join(argspec)
-            if not isinstance(argspecj, str):
-                argspecj = str(argspecj, locale.getlocale()[1])
-            raise ValueError(_("Invalid custom function signature.\nToo few arguments: %s") % argspecj)
-        elif nargs > 7:       # indicates function provides for custom params
+            import inspect
+            if bf[0] == "__main__":
+                customfunction = eval("""sys.modules["__main__"].%s""" % bf[1])
+            else:
+                exec("from %s import %s" % (bf[0], bf[1]))
+                customfunction = locals()[bf[1]]
+            argspec = inspect.getfullargspec(customfunction)[0]
+            nargs = len(argspec)
+            if nargs < 7 or nargs > 8:
+                import locale
+                argspecj = ", ".join(argspec)
+                if not isinstance(argspecj, str):
+                    argspecj = str(argspecj, locale.getlocale()[1])
+                raise ValueError(_("Invalid custom function signature.\nToo few arguments: %s") % argspecj)
+            if bf[0] != "__main__":
+                RESOLVED[f] = (customfunction, nargs)
+        if nargs > 7:       # indicates function provides for custom params
             customfunction = functools.partial(customfunction, custom=CUSTOMPARAMS[f])
         return customfunction
 
@@ -837,6 +2099,7 @@ def factor(afunc):
         except:
             mog = mo.group(2)
             if not isinstance(mog, str):
+                import locale
                 mog = str(mog, locale.getlocale()[1])
             raise ValueError(_("Invalid customfunction parameter expression: %s") % mog)
         f = mo.group(1)
@@ -867,15 +2130,23 @@ class NonProcPivotTable(object):
                 self.rowlabels = []
                 self.columnvalues = []
                 self.rowcount = 0
+                self.counts = {}
         
-        def addrow(self, rowlabel=None, cvalues=None):
+        def addrow(self, rowlabel=None, cvalues=None, count=False):
             """Append a row labelled rowlabel to the table and set value(s) from cvalues.
             
             rowlabel is a label for the stub.
-            cvalues is a sequence of values with the same number of values are there are columns in the table."""
+            cvalues is a sequence of values with the same number of values are there are columns in the table.
+            If count is True, in a one-column table, a repeated rowlabel is counted rather than added again.
+            This is meant for warnings.  Other rows, such as label listings, are kept as they are."""
                 
             if cvalues is None:
                 cvalues = []
+            if count and self.columnlabels == [] and rowlabel is not None:
+                if rowlabel in self.counts:
+                    self.counts[rowlabel] += 1
+                    return
+                self.counts[rowlabel] = 1
             self.rowcount += 1
             if rowlabel is None:
                     self.rowlabels.append(str(self.rowcount))
@@ -903,12 +2174,17 @@ class NonProcPivotTable(object):
                     if self.columnlabels != []:
                             table.SimplePivotTable(self.rowdim, self.rowlabels, self.coldim, self.columnlabels, self.columnvalues)
                     else:
-                            table.Append(spss.Dimension.Place.row,"rowdim",hideName=True,hideLabels=True)
-                            table.Append(spss.Dimension.Place.column,"coldim",hideName=True,hideLabels=True)
+                            rowdim = table.Append(spss.Dimension.Place.row,"rowdim",hideName=True,hideLabels=True)
+                            coldim = table.Append(spss.Dimension.Place.column,"coldim",hideName=True,hideLabels=True)
                             colcat = spss.CellText.String("Message")
+                            cells = []
                             for r in self.rowlabels:
-                                    cellr = spss.CellText.String(r)
-                                    table[(cellr, colcat)] = cellr
+                                    if self.counts.get(r, 1) > 1:
+                                            r = _("%s (occurred %d times)") % (r, self.counts[r])
+                                    cells.append(spss.CellText.String(r))
+                            table.SetCategories(rowdim, cells)
+                            table.SetCategories(coldim, colcat)
+                            table.SetCellsByColumn(colcat, cells)
                     if privateproc:
                             spss.EndProcedure()
 def _isseq(obj):